@@ -0,0 +1,33 @@
+from model import CCMModel
+from criterion import criterion, fused_criterion
+from utils import to_device
+from benchmarks.common import get_parser, setup, get_batches, timeit, peak_memory, train_step, report
+
+
+if __name__ == '__main__':
+    parser = get_parser('decoder activation checkpointing')
+    parser.add_argument('--segments', type=int, nargs='+', default=[0, 4, 8, 16])
+    parser.add_argument('--fused_loss', action='store_true')
+    args = parser.parse_args()
+    if args.teacher_forcing < 1:
+        parser.error('only the teacher-forced decoder is checkpointed: use --teacher_forcing 1')
+    setup(args)
+    dataset, batches = get_batches(args)
+    model = CCMModel(args, dataset).to(args.device).train()
+    loss_fn = fused_criterion if args.fused_loss else criterion
+
+    result = {}
+    for segment in args.segments:
+        model.checkpoint_segment = segment
+        step_time, peak, n_sample = 0., 0, 0
+        for batch in batches:
+            batch = to_device(batch, args.device)
+            (_, t), mem = peak_memory(lambda: timeit(lambda: train_step(model, batch, loss_fn)), args.device)
+            step_time += t
+            peak = max(peak, mem or 0)
+            n_sample += batch['response'].size(0)
+        result[f'segment_{segment}'] = {
+            'samples_per_sec': n_sample / step_time,
+            'peak_memory_bytes': peak if args.device.type == 'cuda' else None,
+        }
+    report(args, result)
@@ -0,0 +1,100 @@
+import argparse
+import json
+import time
+import torch
+from dataset import get_dataloader
+from criterion import criterion, batch_loss
+
+
+def get_parser(description='benchmark'):
+    """ Model/data arguments shared with trainer.py; run benchmarks from the repo root as `python -m benchmarks.<name>`. """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--data_name', type=str, default='valid')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--batch_access', type=int, default=16)
+    parser.add_argument('--n_batches', type=int, default=20)
+    parser.add_argument('--teacher_forcing', type=float, default=1.0)
+    parser.add_argument('--d_embed', type=int, default=300)
+    parser.add_argument('--t_embed', type=int, default=100)
+    parser.add_argument('--hidden', type=int, default=128)
+    parser.add_argument('--n_glove_vocab', type=int, default=30000)
+    parser.add_argument('--n_entity_vocab', type=int, default=22590)
+    parser.add_argument('--gru_layer', type=int, default=2)
+    parser.add_argument('--gru_hidden', type=int, default=512)
+    parser.add_argument('--max_sentence_len', type=int, default=150)
+    parser.add_argument('--max_triple_len', type=int, default=50)
+    parser.add_argument('--max_response_len', type=int, default=150)
+    parser.add_argument('--data_piece_size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=41)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--baseline', action='store_true')
+    parser.add_argument('--no_cuda', action='store_true')
+    parser.add_argument('--output', type=str, default=None, help='write the result as json')
+    return parser
+
+
+def setup(args):
+    args.world_size = 1
+    args.local_rank = 0
+    args.distributed = False
+    torch.manual_seed(args.seed)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    args.device = torch.device('cuda' if torch.cuda.is_available() and not args.no_cuda else 'cpu')
+
+
+def get_batches(args):
+    """ First n_batches of the (unshuffled) split, kept in memory so that only model time is measured. """
+    loader = get_dataloader(args, data_path=args.data_dir, data_name=args.data_name, batch_size=args.batch_size,
+                            shuffle=False, num_workers=args.num_workers)
+    batches = []
+    for batch in loader:
+        batches.append(batch)
+        if len(batches) == args.n_batches:
+            break
+    return loader.dataset, batches
+
+
+def timeit(fn, repeat=1):
+    """ Returns (result of the last call, seconds per call). """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def peak_memory(fn, device):
+    """ Returns (result, peak allocated bytes) on CUDA; (result, None) on CPU where allocations are not tracked. """
+    if device.type != 'cuda':
+        return fn(), None
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    result = fn()
+    torch.cuda.synchronize(device)
+    return result, torch.cuda.max_memory_allocated(device)
+
+
+def train_step(model, batch, loss_fn=criterion, optimizer=None):
+    """
+    zero_grad, forward, batch_loss and backward, then optimizer.step() if an optimizer is given (else the caller steps).
+    Returns (loss, nll_loss, output); the losses are detached device tensors.
+    """
+    if optimizer is not None:
+        optimizer.zero_grad()
+    else:
+        model.zero_grad()
+    output, pointer_prob, output_vocab = model(batch)
+    loss, nll_loss = batch_loss(output, pointer_prob, batch, loss_fn, output_vocab)
+    loss.backward()
+    if optimizer is not None:
+        optimizer.step()
+    return loss.detach(), nll_loss.detach(), output
+
+
+def report(args, result):
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
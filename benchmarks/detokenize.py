@@ -0,0 +1,49 @@
+import argparse
+import numpy as np
+from detokenizer import Detokenizer
+from dataset import SOS_IDX, EOS_IDX, PAD_IDX
+from benchmarks.common import timeit, report
+
+
+def loop_decode(ids, idx2word):
+    """ The former Recorder.log_text decoding: one dict lookup per token. """
+    sentences = []
+    for line in ids:
+        line_text = []
+        for idx in line:
+            idx = idx.item()
+            if idx == EOS_IDX:
+                break
+            if idx != SOS_IDX and idx != PAD_IDX:
+                line_text.append(idx2word.get(idx, 'UNK'))
+        sentences.append(' '.join(line_text))
+    return sentences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batched detokenization')
+    parser.add_argument('--n_vocab', type=int, default=52590)
+    parser.add_argument('--n_seq', type=int, default=4096)
+    parser.add_argument('--seq_len', type=int, default=150)
+    parser.add_argument('--seed', type=int, default=41)
+    parser.add_argument('--output', type=str, default=None, help='write the result as json')
+    args = parser.parse_args()
+
+    # synthetic vocabulary and responses: SOS, random words, EOS at a random position, then PAD
+    rng = np.random.RandomState(args.seed)
+    idx2word = {idx: f'word{idx}' for idx in range(args.n_vocab)}
+    ids = rng.randint(EOS_IDX + 1, args.n_vocab, size=(args.n_seq, args.seq_len))
+    ids[:, 0] = SOS_IDX
+    eos = rng.randint(2, args.seq_len, size=args.n_seq)
+    ids[np.arange(args.n_seq), eos] = EOS_IDX
+    ids[np.arange(args.seq_len)[None] > eos[:, None]] = PAD_IDX
+
+    detokenizer = Detokenizer(idx2word)
+    loop, loop_time = timeit(lambda: loop_decode(ids, idx2word))
+    batched, batched_time = timeit(lambda: detokenizer.decode(ids), repeat=5)
+    assert loop == batched
+    report(args, {
+        'loop_seq_per_sec': args.n_seq / loop_time,
+        'batched_seq_per_sec': args.n_seq / batched_time,
+        'speedup': loop_time / batched_time,
+    })
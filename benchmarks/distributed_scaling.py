@@ -0,0 +1,69 @@
+import os
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from dataset import get_dataloader
+from model import CCMModel, Baseline
+from criterion import criterion, baseline_criterion
+from optimizer import get_optimizer
+from utils import init_distributed, to_device
+from benchmarks.common import get_parser, train_step, report
+
+
+def worker(local_rank, world_size, args, queue):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(args.port), 'WORLD_SIZE': str(world_size),
+                       'RANK': str(local_rank), 'LOCAL_RANK': str(local_rank), 'LOCAL_WORLD_SIZE': str(world_size)})
+    args.local_rank = local_rank
+    args.no_cuda = True
+    device = init_distributed(args)
+    torch.manual_seed(args.seed)
+
+    loader = get_dataloader(args, data_path=args.data_dir, data_name='train', batch_size=args.batch_size, num_workers=args.num_workers)
+    model = CCMModel(args, loader.dataset) if not args.baseline else Baseline(args)
+    loss_fn = criterion if not args.baseline else baseline_criterion
+    optimizer = get_optimizer(model, 1e-4)
+    if args.distributed:
+        model = DDP(model)
+    model.train()
+
+    n_sample, elapsed = 0, 0.
+    for batch_idx, batch in enumerate(loader):
+        if batch_idx == args.n_batches:
+            break
+        batch = to_device(batch, device)
+        start_time = time.perf_counter()
+        train_step(model, batch, loss_fn, optimizer)
+        if batch_idx >= args.warmup:
+            elapsed += time.perf_counter() - start_time
+            n_sample += batch['response'].size(0)
+
+    stats = torch.tensor([n_sample, elapsed], dtype=torch.float64)
+    if args.distributed:
+        dist.all_reduce(stats)
+    if args.rank == 0:
+        # samples of all ranks over the mean per-rank time
+        queue.put({'samples_per_sec': stats[0].item() / (stats[1].item() / world_size), 'threads_per_rank': torch.get_num_threads()})
+
+
+if __name__ == '__main__':
+    parser = get_parser('distributed CPU scaling')
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--port', type=int, default=29511)
+    parser.add_argument('--local_rank', type=int, default=0)
+    args = parser.parse_args()
+    args.data_name = 'train'
+
+    result = {}
+    ctx = mp.get_context('spawn')
+    for world_size in args.world_sizes:
+        queue = ctx.SimpleQueue()
+        mp.spawn(worker, args=(world_size, args, queue), nprocs=world_size, join=True)
+        result[f'world_size_{world_size}'] = queue.get()
+        args.port += 1
+    base = result[f'world_size_{args.world_sizes[0]}']['samples_per_sec']
+    for stats in result.values():
+        stats['scaling'] = stats['samples_per_sec'] / base
+    report(args, result)
@@ -0,0 +1,30 @@
+from model import CCMModel
+from criterion import criterion, fused_criterion
+from utils import to_device
+from benchmarks.common import get_parser, setup, get_batches, timeit, peak_memory, train_step, report
+
+
+if __name__ == '__main__':
+    parser = get_parser('fused pointer-generator loss')
+    args = parser.parse_args()
+    setup(args)
+    dataset, batches = get_batches(args)
+    model = CCMModel(args, dataset).to(args.device).train()
+
+    result = {}
+    for name, fused, loss_fn in [('exact', False, criterion), ('fused', True, fused_criterion)]:
+        model.fused_loss = fused
+        step_time, peak, output_bytes = 0., 0, 0
+        for batch in batches:
+            batch = to_device(batch, args.device)
+            ((_, _, output), t), mem = peak_memory(lambda: timeit(lambda: train_step(model, batch, loss_fn)), args.device)
+            step_time += t
+            peak = max(peak, mem or 0)
+            output_bytes = max(output_bytes, output.numel() * output.element_size())
+        result[name] = {
+            'step_time': step_time / len(batches),
+            'peak_memory_bytes': peak if args.device.type == 'cuda' else None,
+            'max_output_bytes': output_bytes,
+        }
+    result['speedup'] = result['exact']['step_time'] / result['fused']['step_time']
+    report(args, result)
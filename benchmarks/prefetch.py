@@ -0,0 +1,56 @@
+import itertools
+import time
+import torch
+from dataset import get_dataloader
+from prefetcher import Prefetcher
+from model import CCMModel, Baseline
+from criterion import criterion, baseline_criterion
+from optimizer import get_optimizer
+from utils import to_device
+from benchmarks.common import get_parser, setup, train_step, report
+
+
+def run(model, optimizer, loader, loss_fn, device, n_batches, depth):
+    """ n_batches training steps reading straight from the loader, or through a Prefetcher of this depth. """
+    batches = Prefetcher(loader, device, depth) if depth else loader
+    n_sample = 0
+    start = time.perf_counter()
+    it = iter(batches)
+    try:
+        for batch in itertools.islice(it, n_batches):
+            if not depth:
+                batch = to_device(batch, device)
+            train_step(model, batch, loss_fn, optimizer)
+            n_sample += batch['response'].size(0)
+    finally:
+        if depth:
+            # islice leaves the Prefetcher suspended: closing it stops its thread, which releases the loader workers
+            it.close()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    result = {'samples_per_sec': n_sample / elapsed, 'step_ms': 1000. * elapsed / n_batches}
+    if depth:
+        result.update(fetch_ms=1000. * batches.fetch_time / n_batches, wait_ms=1000. * batches.wait_time / n_batches,
+                      hidden_ms=1000. * batches.hidden_time / n_batches)
+    return result
+
+
+if __name__ == '__main__':
+    parser = get_parser('overlapped loading and host-to-device copy')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2])
+    args = parser.parse_args()
+    setup(args)
+    loader = get_dataloader(args, data_path=args.data_dir, data_name=args.data_name, batch_size=args.batch_size,
+                            shuffle=False, num_workers=args.num_workers)
+    loss_fn = criterion if not args.baseline else baseline_criterion
+
+    result = {}
+    for depth in [0] + args.depths:
+        torch.manual_seed(args.seed)
+        model = (CCMModel(args, loader.dataset) if not args.baseline else Baseline(args)).to(args.device).train()
+        optimizer = get_optimizer(model, 1e-4)
+        result['no_prefetch' if depth == 0 else f'prefetch_{depth}'] = run(model, optimizer, loader, loss_fn, args.device, args.n_batches, depth)
+    for depth in args.depths:
+        result[f'prefetch_{depth}']['speedup'] = result[f'prefetch_{depth}']['samples_per_sec'] / result['no_prefetch']['samples_per_sec']
+    report(args, result)
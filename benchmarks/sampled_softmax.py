@@ -0,0 +1,54 @@
+import torch
+import torch.optim as optim
+from model import CCMModel, Baseline
+from criterion import criterion, baseline_criterion, batch_loss, perplexity
+from benchmarks.common import get_parser, setup, get_batches, timeit, train_step, report
+
+
+def train_steps(model, optimizer, batches, loss_fn):
+    model.train()
+    for batch in batches:
+        train_step(model, dict(batch), loss_fn, optimizer)
+
+
+def valid_perplexity(model, batches, loss_fn):
+    """ Exact-head perplexity (sampled softmax is only used in train mode). """
+    model.eval()
+    total_pp, n_sample = 0., 0
+    with torch.no_grad():
+        for batch in batches:
+            batch = dict(batch)
+            output, pointer_prob, output_vocab = model(batch)
+            _, nll_loss = batch_loss(output, pointer_prob, batch, loss_fn, output_vocab)
+            total_pp += perplexity(nll_loss).item() * batch['response'].size(0)
+            n_sample += batch['response'].size(0)
+    return total_pp / n_sample
+
+
+if __name__ == '__main__':
+    parser = get_parser('sampled softmax')
+    parser.add_argument('--sampled_softmax', type=int, default=4096)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    args = parser.parse_args()
+    setup(args)
+    args.data_name = 'train'
+    dataset, train_batches = get_batches(args)
+    args.data_name = 'valid'
+    _, valid_batches = get_batches(args)
+    loss_fn = criterion if not args.baseline else baseline_criterion
+
+    result = {}
+    for name, n_sample in [('exact', 0), ('sampled', args.sampled_softmax)]:
+        torch.manual_seed(args.seed)
+        model = CCMModel(args, dataset) if not args.baseline else Baseline(args)
+        model.sampled_softmax = n_sample
+        optimizer = optim.Adam(model.parameters(), args.lr)
+        _, elapsed = timeit(lambda: train_steps(model, optimizer, train_batches, loss_fn))
+        n_train = sum(batch['response'].size(0) for batch in train_batches)
+        result[name] = {
+            'n_sample': n_sample,
+            'train_samples_per_sec': n_train / elapsed,
+            'valid_perplexity': valid_perplexity(model, valid_batches, loss_fn),
+        }
+    result['speedup'] = result['sampled']['train_samples_per_sec'] / result['exact']['train_samples_per_sec']
+    report(args, result)
@@ -0,0 +1,50 @@
+import torch
+from model import CCMModel, Baseline
+from criterion import criterion, baseline_criterion
+from optimizer import get_optimizer
+from utils import to_device
+from benchmarks.common import get_parser, setup, get_batches, timeit, train_step, report
+
+
+def grad_bytes(model):
+    total = 0
+    for param in model.parameters():
+        if param.grad is None:
+            continue
+        grad = param.grad
+        if grad.is_sparse:
+            grad = grad.coalesce()
+            total += grad.values().numel() * grad.values().element_size() + grad.indices().numel() * grad.indices().element_size()
+        else:
+            total += grad.numel() * grad.element_size()
+    return total
+
+
+if __name__ == '__main__':
+    parser = get_parser('sparse embedding gradients')
+    parser.add_argument('--lr', type=float, default=1e-4)
+    args = parser.parse_args()
+    setup(args)
+    dataset, batches = get_batches(args)
+    loss_fn = criterion if not args.baseline else baseline_criterion
+
+    result = {}
+    for name, sparse in [('dense', False), ('sparse', True)]:
+        args.sparse_embedding = sparse
+        torch.manual_seed(args.seed)
+        model = (CCMModel(args, dataset) if not args.baseline else Baseline(args)).to(args.device).train()
+        optimizer = get_optimizer(model, args.lr, sparse)
+        step_time, max_grad_bytes = 0., 0
+        for batch in batches:
+            batch = to_device(batch, args.device)
+            train_step(model, batch, loss_fn)
+            max_grad_bytes = max(max_grad_bytes, grad_bytes(model))
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize(args.device)
+            _, t = timeit(optimizer.step)
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize(args.device)
+            step_time += t
+        result[name] = {'optimizer_step_time': step_time / len(batches), 'max_grad_bytes': max_grad_bytes}
+    result['speedup'] = result['dense']['optimizer_step_time'] / result['sparse']['optimizer_step_time']
+    report(args, result)
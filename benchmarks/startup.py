@@ -0,0 +1,62 @@
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataset import CommonsenseDialDataset
+from benchmarks.common import get_parser, setup, timeit, report
+from benchmarks.synthetic import generate
+
+MODULES = ['torch', 'dataset', 'criterion', 'detokenizer', 'model', 'export', 'evaluate', 'trainer']
+HEAVY = ['pathos', 'zarr', 'redis', 'jsonlines', 'tqdm', 'ipdb', 'pandas', 'fuzzywuzzy']
+SNIPPET = ('import json, sys, time; start = time.perf_counter(); import {module}; '
+           'print(json.dumps([time.perf_counter() - start, [m for m in {heavy} if m in sys.modules]]))')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(module, repeat):
+    """ Best-of-repeat import time in fresh interpreters (torch is the floor), and the heavy modules it loaded. """
+    times = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', SNIPPET.format(module=module, heavy=HEAVY)],
+                              cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            return {'error': proc.stderr.strip().splitlines()[-1]}
+        elapsed, loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+        times.append(elapsed)
+    return {'import_ms': 1000. * min(times), 'heavy_modules': loaded}
+
+
+def time_construction(args):
+    """ Dataset construction once the zarr dump exists, first use of each lazy resource and the worker payload. """
+    CommonsenseDialDataset(args, args.data_dir, 'train')  # builds vocab.pkl and the dump, see benchmarks.suite
+    dataset, construct = timeit(lambda: CommonsenseDialDataset(args, args.data_dir, 'train'), repeat=5)
+    result = {'construct_ms': 1000. * construct}
+    for name in ['data', 'vocab', 'idx2word', 'rel2idx', 'triple_dict']:
+        _, t = timeit(lambda: getattr(dataset, name))
+        result[f'first_{name}_ms'] = 1000. * t
+    payload = pickle.dumps(dataset)
+    worker = pickle.loads(payload)
+    _, t = timeit(lambda: worker[0])
+    result.update(worker_payload_bytes=len(payload), worker_first_getitem_ms=1000. * t)
+    return result
+
+
+if __name__ == '__main__':
+    parser = get_parser('import and dataset construction time')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--n_entity', type=int, default=2000)
+    parser.set_defaults(n_glove_vocab=5000, max_sentence_len=60, max_triple_len=20, max_response_len=60, data_piece_size=512)
+    args = parser.parse_args()
+    setup(args)
+
+    result = {'imports': {module: time_import(module, args.repeat) for module in MODULES}}
+    args.data_dir = tempfile.mkdtemp(prefix='ccm_synthetic_')
+    try:
+        generate(args.data_dir, args, {'train': args.data_piece_size}, n_entity=args.n_entity, seed=args.seed)
+        result['dataset'] = time_construction(args)
+    finally:
+        shutil.rmtree(args.data_dir)
+    report(args, result)
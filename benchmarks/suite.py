@@ -0,0 +1,128 @@
+import shutil
+import tempfile
+import numpy as np
+import torch
+from dataset import CommonsenseDialDataset, collate_fn
+from model import CCMModel
+from export import ScriptableCCM, greedy_decode
+from criterion import criterion, batch_loss
+from utils import to_device
+from benchmarks.common import get_parser, setup, timeit, report
+from benchmarks.synthetic import generate
+
+
+def time_dataset(args):
+    """ Cold construction builds vocab.pkl and the zarr dump from the jsonl pieces (init_data); warm finds them (resources load lazily). """
+    dataset, cold = timeit(lambda: CommonsenseDialDataset(args, args.data_dir, 'train'))
+    dataset, warm = timeit(lambda: CommonsenseDialDataset(args, args.data_dir, 'train'))
+    return dataset, {'n_samples': len(dataset), 'init_data_s': cold, 'construct_s': warm}
+
+
+def time_loading(args, dataset):
+    """ __getitem__ + collate_fn for n_batches batches, as a DataLoader worker runs them. """
+    n_access = args.batch_size // args.batch_access
+    starts = list(range(0, len(dataset), args.batch_access))[:args.n_batches * n_access]
+    groups = [starts[i:i + n_access] for i in range(0, len(starts), n_access)]
+    getitem_time, collate_time, batches = 0., 0., []
+    for group in groups:
+        items, t = timeit(lambda: [dataset[i] for i in group])
+        getitem_time += t
+        batch, t = timeit(lambda: collate_fn(items))
+        collate_time += t
+        batches.append(batch)
+    return batches, {'getitem_ms': 1000. * getitem_time / len(groups), 'collate_ms': 1000. * collate_time / len(groups)}
+
+
+def time_training(args, model, batches):
+    forward_time, backward_time, n_sample = 0., 0., 0
+    model.train()
+    for batch in batches:
+        batch = to_device(batch, args.device)
+        model.zero_grad()
+        (output, pointer_prob, output_vocab), t = timeit(lambda: model(batch))
+        forward_time += t
+        loss, _ = batch_loss(output, pointer_prob, batch, criterion, output_vocab)
+        _, t = timeit(lambda: loss.backward())
+        backward_time += t
+        n_sample += batch['response'].size(0)
+    return {'forward_ms': 1000. * forward_time / len(batches), 'backward_ms': 1000. * backward_time / len(batches),
+            'samples_per_sec': n_sample / (forward_time + backward_time)}
+
+
+def time_decoding(args, model, batches):
+    module = ScriptableCCM(model).eval()
+    decode_time, n_sample, n_token = 0., 0, 0
+    with torch.no_grad():
+        for batch in batches:
+            batch = to_device(batch, args.device)
+            tokens, t = timeit(lambda: greedy_decode(module, batch['post'], batch['post_length'], batch['triple'], batch['entity'],
+                                                     args.max_response_len))
+            decode_time += t
+            n_sample += tokens.size(0)
+            n_token += tokens.numel()
+    return {'decode_ms': 1000. * decode_time / len(batches), 'samples_per_sec': n_sample / decode_time,
+            'tokens_per_sec': n_token / decode_time}
+
+
+def time_graph(args, dataset):
+    """
+    Per-query graph lookup from the in-memory triple_dict, and with --redis from RedisGraph (retrieve_graph).
+    --redis stores the queried part of the synthetic graph as --redis_graph on --redis_host:--redis_port,
+    and deletes that graph afterwards; the 'CCM' graph of the data is never touched.
+    """
+    rng = np.random.RandomState(args.seed)
+    queries = [int(q) for q in rng.choice(list(dataset.entity_lst), args.n_queries)]
+    _, t = timeit(lambda: [dataset.triple_dict[q] for q in queries])
+    result = {'triple_dict_us': 1e6 * t / len(queries)}
+    if args.redis:
+        import redis
+        from graph import store_graph
+        rd = redis.StrictRedis(host=args.redis_host, port=args.redis_port)
+        triples = {', '.join([dataset.idx2word[h], dataset.idx2rel[r], dataset.idx2word[t]])
+                   for q in queries for h, r, t in dataset.triple_dict[q]}
+        rd.delete(args.redis_graph)  # edges are CREATEd, a leftover graph would hold them twice
+        try:
+            store_graph(rd, sorted(triples), args.redis_graph)
+            _, t = timeit(lambda: [dataset.retrieve_graph(q, rd, args.redis_graph) for q in queries])
+        finally:
+            rd.delete(args.redis_graph)
+        result['redis_us'] = 1e6 * t / len(queries)
+    return result
+
+
+if __name__ == '__main__':
+    parser = get_parser('end-to-end suite on synthetic data')
+    parser.add_argument('--n_entity', type=int, default=2000)
+    parser.add_argument('--n_queries', type=int, default=200)
+    parser.add_argument('--redis', action='store_true', help='also time RedisGraph retrieval (writes, then deletes, --redis_graph)')
+    parser.add_argument('--redis_host', type=str, default='localhost')
+    parser.add_argument('--redis_port', type=int, default=6379)
+    parser.add_argument('--redis_graph', type=str, default='CCM_benchmark', help='scratch graph name, not the CCM graph of the data')
+    parser.add_argument('--keep_data', action='store_true', help='keep the generated data directory')
+    # small enough for a CPU-only machine, with the shapes of the real data
+    parser.set_defaults(n_glove_vocab=5000, max_sentence_len=60, max_triple_len=20, max_response_len=60,
+                        data_piece_size=512, batch_size=32, batch_access=4, n_batches=10, gru_hidden=256)
+    args = parser.parse_args()
+    if args.redis and args.redis_graph == 'CCM':
+        parser.error('--redis_graph CCM would overwrite (and delete) the graph of the data')
+    setup(args)
+    args.data_dir = tempfile.mkdtemp(prefix='ccm_synthetic_')
+
+    result = {'config': {key: getattr(args, key) for key in ['n_glove_vocab', 'n_entity', 'max_sentence_len', 'max_triple_len',
+                                                               'batch_size', 'batch_access', 'n_batches', 'gru_hidden']}}
+    result['config']['device'] = str(args.device)
+    try:
+        _, result['generate_s'] = timeit(lambda: generate(args.data_dir, args, n_entity=args.n_entity, seed=args.seed))
+        dataset, result['dataset'] = time_dataset(args)
+        batches, result['loading'] = time_loading(args, dataset)
+        torch.manual_seed(args.seed)
+        model = CCMModel(args, dataset).to(args.device)
+        result['training'] = time_training(args, model, batches)
+        result['greedy_decode'] = time_decoding(args, model, batches)
+        result['graph'] = time_graph(args, dataset)
+    finally:
+        if args.keep_data:
+            print(f'Synthetic data kept in {args.data_dir}')
+        else:
+            shutil.rmtree(args.data_dir)
+    report(args, result)
@@ -0,0 +1,42 @@
+import torch
+from model import CCMModel, Baseline
+from criterion import criterion, baseline_criterion, perplexity
+from optimizer import get_optimizer
+from utils import to_device
+from benchmarks.common import get_parser, setup, get_batches, timeit, train_step, report
+
+
+def run(model, optimizer, batches, loss_fn, device, sync_every_step):
+    """ Training steps with per-step .item() reads (the old loop) or float64 device sums read once at the end. """
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    py_loss_sum = 0.
+    for batch in batches:
+        batch = to_device(batch, device)
+        loss, nll_loss, _ = train_step(model, batch, loss_fn, optimizer)
+        pp = perplexity(nll_loss)
+        batch_size = batch['response'].size(0)
+        if sync_every_step:
+            py_loss_sum += loss.item() * batch_size
+            pp.item()
+        else:
+            loss_sum += loss.double() * batch_size
+    return py_loss_sum if sync_every_step else loss_sum.item()
+
+
+if __name__ == '__main__':
+    parser = get_parser('sync-free metric accumulation')
+    args = parser.parse_args()
+    setup(args)
+    dataset, batches = get_batches(args)
+    loss_fn = criterion if not args.baseline else baseline_criterion
+    n_sample = sum(batch['response'].size(0) for batch in batches)
+
+    result = {}
+    for name, sync_every_step in [('item_per_step', True), ('device_sums', False)]:
+        torch.manual_seed(args.seed)
+        model = (CCMModel(args, dataset) if not args.baseline else Baseline(args)).to(args.device).train()
+        optimizer = get_optimizer(model, 1e-4)
+        loss_sum, elapsed = timeit(lambda: run(model, optimizer, batches, loss_fn, args.device, sync_every_step))
+        result[name] = {'samples_per_sec': n_sample / elapsed, 'loss_sum': loss_sum}
+    result['speedup'] = result['device_sums']['samples_per_sec'] / result['item_per_step']['samples_per_sec']
+    report(args, result)
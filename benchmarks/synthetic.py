@@ -0,0 +1,130 @@
+import os
+import jsonlines
+import numpy as np
+from benchmarks.common import get_parser
+
+RELATIONS = ['RelatedTo', 'IsA', 'PartOf', 'HasA', 'UsedFor', 'CapableOf', 'AtLocation', 'Causes', 'HasSubevent',
+             'HasPrerequisite', 'HasProperty', 'MotivatedByGoal', 'Desires', 'CreatedBy', 'Synonym', 'Antonym',
+             'DistinctFrom', 'DerivedFrom', 'SymbolOf', 'DefinedAs', 'MannerOf', 'LocatedNear', 'SimilarTo',
+             'MadeOf', 'ReceivesAction', 'CausesDesire', 'NotDesires', 'HasContext', 'FormOf', 'EtymologicallyRelatedTo',
+             'HasFirstSubevent', 'HasLastSubevent', 'InstanceOf', 'Entails', 'NotCapableOf', 'NotHasProperty',
+             'ObstructedBy', 'NotUsedFor', 'LocatedAt', 'dbpedia', 'ExternalURL', 'HasPainIntensity', 'HasPainCharacter',
+             'InheritsFrom']
+
+
+def write_vectors(path, n, dim, rng, labels=None):
+    """ n random vectors: `label v1 ... vd` rows like GloVe, or tab-separated values only (labels=None) like TransE. """
+    vectors = rng.randn(n, dim).astype('float32')
+    with open(path, 'w') as f:
+        for i, vector in enumerate(vectors):
+            if labels is not None:
+                f.write(labels[i] + ' ' + ' '.join('{:.5f}'.format(v) for v in vector) + '\n')
+            else:
+                f.write('\t'.join('{:.5f}'.format(v) for v in vector) + '\n')
+
+
+def zipf_choice(rng, n, size, a=1.2):
+    """ Ranks 0..n-1 drawn with Zipfian frequencies, like the frequency-ordered GloVe vocab. """
+    return np.minimum(rng.zipf(a, size=size) - 1, n - 1)
+
+
+def make_sample(rng, args, words, entities, dict_csk, triple2idx, ent2idx):
+    """
+    One jsonl line in the format of the CCM release: post/response words, and for each post word the (1-based)
+    index of its retrieved graph in all_triples (0: none); all_entities holds the other end of each triple, and
+    response words copied from a graph point to their triple in response_triples (-1 otherwise).
+    """
+    max_len = args.max_sentence_len - 2
+    post_len = int(np.clip(rng.poisson(12), 2, max_len))
+    response_len = int(np.clip(rng.poisson(14), 2, min(max_len, args.max_response_len - 2)))
+    post = [words[i] for i in zipf_choice(rng, len(words), post_len)]
+
+    post_triples, all_triples, all_entities, candidates = [0] * post_len, [], [], []
+    graph_pos = rng.choice(post_len, size=rng.randint(1, min(post_len, 5) + 1), replace=False)
+    for pos in sorted(graph_pos):
+        head = entities[rng.randint(len(entities))]
+        post[pos] = head
+        triples = dict_csk[head][:args.max_triple_len]
+        post_triples[pos] = len(all_triples) + 1
+        all_triples.append([triple2idx[t] for t in triples])
+        others = []
+        for t in triples:
+            h, _, tail = t.split(', ')
+            other = tail if h == head else h
+            others.append(ent2idx[other])
+            candidates.append((other, triple2idx[t]))
+        all_entities.append(others)
+
+    response = [words[i] for i in zipf_choice(rng, len(words), response_len)]
+    response_triples = [-1] * response_len
+    for pos in rng.choice(response_len, size=min(response_len, rng.randint(0, 3)), replace=False):
+        word, triple_idx = candidates[rng.randint(len(candidates))]
+        response[pos] = word
+        response_triples[pos] = triple_idx
+    return {'post': post, 'response': response, 'post_triples': post_triples, 'all_triples': all_triples,
+            'all_entities': all_entities, 'response_triples': response_triples}
+
+
+def generate(data_dir, args, n_samples=None, n_entity=2000, n_relation=40, triples_per_entity=8, seed=0):
+    """
+    Writes a small but realistically shaped copy of the CCM data into data_dir: resource.txt, relation.txt,
+    entity.txt, the GloVe file (args.n_glove_vocab x args.d_embed), TransE files (t_embed dims) and
+    <split>set_pieces/*.jsonl with args.data_piece_size lines per piece.
+    n_samples: {split: n_lines}, rounded up to whole pieces.
+    """
+    rng = np.random.RandomState(seed)
+    n_samples = n_samples or {'train': 4 * args.data_piece_size, 'valid': args.data_piece_size, 'test': args.data_piece_size}
+    os.makedirs(data_dir, exist_ok=True)
+
+    # GloVe words are frequency ordered; half of the entities are GloVe words, the rest are out of vocab
+    words = [f'w{i}' for i in range(args.n_glove_vocab)]
+    entities = sorted(set(words[i] for i in rng.choice(len(words), n_entity // 2, replace=False)))
+    entities += [f'e{i}' for i in range(n_entity - len(entities))]
+    relations = RELATIONS[:n_relation] + [f'Rel{i}' for i in range(n_relation - len(RELATIONS))]
+    ent2idx = {ent: idx for idx, ent in enumerate(entities)}
+
+    triples = set()
+    for head in entities:
+        for tail in rng.choice(entities, triples_per_entity // 2):
+            if tail != head:
+                triples.add(f'{head}, {relations[rng.randint(len(relations))]}, {tail}')
+    triples = sorted(triples)
+    triple2idx = {triple: idx for idx, triple in enumerate(triples)}
+    dict_csk = {ent: [] for ent in entities}
+    for triple in triples:
+        head, _, tail = triple.split(', ')
+        dict_csk[head].append(triple)
+        dict_csk[tail].append(triple)
+    entities_with_graph = [ent for ent in entities if dict_csk[ent]]
+
+    resource = {'csk_triples': triples, 'csk_entities': entities, 'dict_csk_triples': triple2idx,
+                'dict_csk_entities': ent2idx, 'dict_csk': dict_csk}
+    with open(f'{data_dir}/resource.txt', 'w') as f:
+        f.write(repr(resource))
+    with open(f'{data_dir}/relation.txt', 'w') as f:
+        f.write('\n'.join(relations) + '\n')
+    with open(f'{data_dir}/entity.txt', 'w') as f:
+        f.write('\n'.join(entities) + '\n')
+    write_vectors(f'{data_dir}/glove.840B.300d.txt', len(words), args.d_embed, rng, labels=words)
+    write_vectors(f'{data_dir}/entity_transE.txt', len(entities), args.t_embed, rng)
+    write_vectors(f'{data_dir}/relation_transE.txt', len(relations), args.t_embed, rng)
+
+    for split, n in n_samples.items():
+        os.makedirs(f'{data_dir}/{split}set_pieces', exist_ok=True)
+        # init_data writes piece k at k * data_piece_size, so every piece is full
+        for piece in range(-(-n // args.data_piece_size)):
+            with jsonlines.open(f'{data_dir}/{split}set_pieces/{split}set_{piece}.jsonl', 'w') as f:
+                for _ in range(args.data_piece_size):
+                    f.write(make_sample(rng, args, words, entities_with_graph, dict_csk, triple2idx, ent2idx))
+    return resource
+
+
+if __name__ == '__main__':
+    parser = get_parser('synthetic CCM data')
+    parser.add_argument('--n_train', type=int, default=4096)
+    parser.add_argument('--n_valid', type=int, default=1024)
+    parser.add_argument('--n_test', type=int, default=1024)
+    parser.add_argument('--n_entity', type=int, default=2000)
+    args = parser.parse_args()
+    generate(args.data_dir, args, {'train': args.n_train, 'valid': args.n_valid, 'test': args.n_test}, n_entity=args.n_entity, seed=args.seed)
+    print(f'Synthetic data written in {args.data_dir}')
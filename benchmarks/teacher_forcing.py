@@ -0,0 +1,28 @@
+from model import CCMModel, Baseline
+from criterion import criterion, baseline_criterion
+from utils import to_device
+from benchmarks.common import get_parser, setup, get_batches, timeit, train_step, report
+
+
+if __name__ == '__main__':
+    parser = get_parser('whole-sequence teacher forcing')
+    args = parser.parse_args()
+    setup(args)
+    dataset, batches = get_batches(args)
+    model = (CCMModel(args, dataset) if not args.baseline else Baseline(args)).to(args.device).train()
+    loss_fn = criterion if not args.baseline else baseline_criterion
+
+    # teacher_forcing just below 1 draws random.random() per step but (almost surely) always feeds the ground truth,
+    # which is the step-by-step path; 1.0 takes the whole-sequence path
+    result = {}
+    for name, teacher_forcing in [('stepwise', 1 - 1e-12), ('whole_sequence', 1.0)]:
+        model.teacher_forcing = teacher_forcing
+        step_time, losses = 0., []
+        for batch in batches:
+            batch = to_device(batch, args.device)
+            (loss, _, _), t = timeit(lambda: train_step(model, batch, loss_fn))
+            step_time += t
+            losses.append(loss.item())
+        result[name] = {'step_time': step_time / len(batches), 'mean_loss': sum(losses) / len(losses)}
+    result['speedup'] = result['stepwise']['step_time'] / result['whole_sequence']['step_time']
+    report(args, result)
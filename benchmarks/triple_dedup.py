@@ -0,0 +1,59 @@
+import torch
+from model import CCMModel
+from utils import to_device
+from benchmarks.common import get_parser, setup, get_batches, timeit, train_step, report
+
+
+def dedup_stats(batch, t_embed, hidden):
+    """ Triple-path FLOPs (forward) and saved-activation bytes with and without unique-triple deduplication. """
+    triple, response_triple = batch['triple'], batch['response_triple']
+    all_triple = torch.cat([triple.view(-1, 3), response_triple.reshape(-1, 3)], 0)
+    n_total = all_triple.size(0)
+    n_unique = torch.unique(all_triple, dim=0).size(0)
+    # MLP (3t -> 3t) and Wh/Wr/Wt (t -> hidden), multiply-adds counted as 2 flops
+    flops_per_triple = 2 * (3 * t_embed) ** 2 + 3 * 2 * t_embed * hidden
+    # h/r/t embeddings, their concat, MLP output, Wh/Wr/Wt outputs, tanh and product (fp32)
+    bytes_per_triple = 4 * (3 * t_embed + 3 * t_embed + 3 * t_embed + 3 * hidden + 2 * hidden)
+    return {
+        'n_triple': n_total,
+        'n_unique_triple': n_unique,
+        'flops_full': n_total * flops_per_triple,
+        'flops_unique': n_unique * flops_per_triple,
+        'activation_bytes_full': n_total * bytes_per_triple,
+        'activation_bytes_unique': n_unique * bytes_per_triple,
+    }
+
+
+def step(model, batch):
+    # forward writes UNK into batch['response']: both variants get their own copy
+    loss, _, _ = train_step(model, {key: val.clone() for key, val in batch.items()})
+    return loss.item()
+
+
+if __name__ == '__main__':
+    parser = get_parser('unique-triple deduplication')
+    args = parser.parse_args()
+    setup(args)
+    dataset, batches = get_batches(args)
+    model = CCMModel(args, dataset).to(args.device).train()
+
+    result = {key: 0 for key in ['n_triple', 'n_unique_triple', 'flops_full', 'flops_unique', 'activation_bytes_full', 'activation_bytes_unique']}
+    time_full, time_unique, max_loss_diff = 0., 0., 0.
+    for batch in batches:
+        for key, val in dedup_stats(batch, args.t_embed, args.hidden).items():
+            result[key] += val
+        batch = to_device(batch, args.device)
+        model.unique_triple = False
+        loss_full, t = timeit(lambda: step(model, batch))
+        time_full += t
+        model.unique_triple = True
+        loss_unique, t = timeit(lambda: step(model, batch))
+        time_unique += t
+        max_loss_diff = max(max_loss_diff, abs(loss_full - loss_unique))
+    result.update({
+        'unique_ratio': result['n_unique_triple'] / result['n_triple'],
+        'step_time_full': time_full / len(batches),
+        'step_time_unique': time_unique / len(batches),
+        'max_loss_diff': max_loss_diff,
+    })
+    report(args, result)
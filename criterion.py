@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from dataset import PAD_IDX
+from dataset import PAD_IDX, NAF_IDX
         
 
 def criterion(output, target, pointer_prob, pointer_prob_target):
@@ -25,10 +25,30 @@ def criterion(output, target, pointer_prob, pointer_prob_target):
     return nll_loss + pointer_prob_loss, nll_loss
 
 
+def fused_criterion(target_log_prob, target, pointer_logit, pointer_prob_target):
+    """
+    Loss for CCMModel with fused_loss (training only): the model already returns log p(target) per step,
+    so this is the exact mixture NLL (not cross_entropy over probabilities as in criterion) plus the pointer BCE.
+    """
+    mask = target.ne(PAD_IDX).to(target_log_prob.dtype)
+    nll_loss = -(target_log_prob * mask).sum() / mask.sum()
+    pointer_prob_loss = F.binary_cross_entropy_with_logits(pointer_logit, pointer_prob_target, reduction='mean')
+    return nll_loss + pointer_prob_loss, nll_loss
+
+
 def perplexity(nll_loss):
     return torch.exp(nll_loss).mean()
 
 
+def reference_nll(target_log_prob, target):
+    """
+    Per-sample summed NLL and number of target tokens, for corpus-level perplexity.
+    target_log_prob: the (bsz, T) log-probs of target from model(batch, reference=True).
+    """
+    mask = target.ne(PAD_IDX)
+    return -target_log_prob.masked_fill(~mask, 0.).sum(1), mask.sum(1)
+
+
 def baseline_criterion(output, target, pointer_prob=None, pointer_prob_target=None):
     batch_size, rl = target.size()
     output_len = output.size()[2]
@@ -41,3 +61,18 @@ def baseline_criterion(output, target, pointer_prob=None, pointer_prob_target=No
     loss = F.cross_entropy(output, target, ignore_index=PAD_IDX, reduction='mean')
     return loss, loss
 
+
+def batch_loss(output, pointer_prob, batch, loss_fn=criterion, output_vocab=None):
+    """
+    Builds the targets from the batch and applies loss_fn; returns (loss, nll_loss).
+    output_vocab: the sampled vocab returned by the model with sampled softmax (targets are mapped onto it).
+    """
+    pointer_prob_target = (batch['response_triple'] != NAF_IDX).all(-1).to(torch.float)
+    pointer_prob_target.data.masked_fill_(batch['response'] == 0, PAD_IDX)
+    target = batch['response'][:, 1:]
+    if output_vocab is not None:
+        # sampled-softmax training: output is over output_vocab (sorted, PAD_IDX stays at 0)
+        vocab2pos = output_vocab.new_zeros(int(output_vocab.max()) + 1)
+        vocab2pos[output_vocab] = torch.arange(output_vocab.size(0), device=output_vocab.device)
+        target = vocab2pos[target]
+    return loss_fn(output, target, pointer_prob, pointer_prob_target[:, 1:])
@@ -3,29 +3,22 @@ import math
 from ast import literal_eval
 from collections import OrderedDict, defaultdict
 import functools
+from functools import cached_property
 import pickle
 from torch.utils.data.distributed import DistributedSampler
 import torch.distributed as dist
-from pathos.helpers import mp
-from pathos.multiprocessing import ProcessingPool as Pool
-import zarr
-import jsonlines
-from tqdm import tqdm
 import numpy as np
 import torch
-import redis
 
 from utils import line_count, pad_1d, pad_2d, append_storage, resize_storage
 
-import ipdb
-
 DEFAULT_VOCAB = ['_PAD', '_NAF', '_UNK', '_SOS', '_EOS']
 PAD_IDX, NAF_IDX, UNK_IDX, SOS_IDX, EOS_IDX = 0, 1, 2, 3, 4
 NAF_TRIPLE = [NAF_IDX, NAF_IDX, NAF_IDX]
 
 
 class DistributedBatchSampler(DistributedSampler):
-    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, batch_access=1):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, batch_access=1, pad=True):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -38,10 +31,20 @@ class DistributedBatchSampler(DistributedSampler):
         self.num_replicas = num_replicas
         self.rank = rank
         self.epoch = 0
-        self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / (self.num_replicas * batch_access)))
-        self.total_size = self.num_samples * self.num_replicas * batch_access
+        if pad:
+            self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / (self.num_replicas * batch_access)))
+            self.total_size = self.num_samples * self.num_replicas * batch_access
+        else:
+            # no repeated samples: ranks may get one chunk less, but their union is exactly the single-process one
+            self.num_samples = len(range(self.rank * batch_access, len(self.dataset), self.num_replicas * batch_access))
+            self.total_size = len(self.dataset)
         self.shuffle = shuffle
         self.batch_access = batch_access
+        self.start = 0
+
+    def set_start(self, start):
+        """ Skip the first `start` indices of this rank (resuming mid-epoch); the epoch length is unchanged. """
+        self.start = start
 
     def __iter__(self):
         # deterministically shuffle based on epoch
@@ -59,7 +62,7 @@ class DistributedBatchSampler(DistributedSampler):
         # subsample
         indices = indices[self.rank*self.batch_access:self.total_size:self.num_replicas*self.batch_access]
         assert len(indices) == self.num_samples
-        return iter(indices)
+        return iter(indices[self.start:])
 
 
 def get_dataloader(args,
@@ -70,12 +73,13 @@ def get_dataloader(args,
                    num_workers=4):
     dataset = CommonsenseDialDataset(args, data_path, data_name)
     batch_size = batch_size // args.batch_access
-    num_replicas = args.world_size if data_name == 'train' else 1
-    sampler = DistributedBatchSampler(dataset=dataset, num_replicas=num_replicas, rank=args.local_rank, shuffle=shuffle, batch_access=args.batch_access)
+    # every split is sharded over ranks; only train repeats samples to even out the shards
+    rank = getattr(args, 'rank', args.local_rank)
+    sampler = DistributedBatchSampler(dataset=dataset, num_replicas=args.world_size, rank=rank, shuffle=shuffle, batch_access=args.batch_access, pad=data_name == 'train')
     data_loader = torch.utils.data.DataLoader(dataset=dataset,
                                             batch_size=batch_size,
                                             num_workers=num_workers,
-                                            pin_memory=True,
+                                            pin_memory=torch.cuda.is_available(),
                                             collate_fn=collate_fn,
                                             sampler=sampler
                                             )
@@ -83,41 +87,77 @@ def get_dataloader(args,
 
 
 class CommonsenseDialDataset(torch.utils.data.Dataset):
+    """
+    Construction only makes sure the zarr dump exists. Everything else (zarr handle, vocabs, triple_dict,
+    the Redis connection) is loaded on first use, and pickling keeps only the constructor fields,
+    so DataLoader workers get what __getitem__ needs and reopen the dump themselves.
+    """
+    state_keys = ('args', 'data_path', 'data_name', 'batch_access', 'data_dump')
+
     def __init__(self, args, data_path='data', data_name='train'):
         assert data_name in ['train', 'test', 'valid'], "Data name should be among ['train', 'test', 'valid']."
         self.args = args
         self.data_path = data_path
+        self.data_name = data_name
         self.batch_access = args.batch_access
-        
-        data_dump = f'{self.data_path}/{data_name}set_new.zarr'
-        vocab_file = f'{self.data_path}/vocab.pkl'
+        self.data_dump = f'{self.data_path}/{data_name}set_new.zarr'
 
-        self.rel2idx = self.make_rel_vocab()
-        self.idx2rel = {val: key for key, val in self.rel2idx.items()}
+        if not os.path.exists(self.data_dump):
+            self.init_data(data_name)
+
+    def __getstate__(self):
+        return {key: self.__dict__[key] for key in self.state_keys}
+
+    @cached_property
+    def data(self):
+        import zarr
+        return zarr.open(self.data_dump, mode='r') # load zarr dump
 
+    @cached_property
+    def vocab(self):
+        vocab_file = f'{self.data_path}/vocab.pkl'
         if not os.path.isfile(vocab_file):
-            self.init_vocab() # only used for init_data
-        else:
-            with open(vocab_file, 'rb') as vf:
-                d = pickle.load(vf)
-                self.word2idx = d['word2idx']
-                self.entidx2wordidx = d['entidx2wordidx']
+            return self.init_vocab() # only used for init_data
+        with open(vocab_file, 'rb') as vf:
+            return pickle.load(vf)
 
-        if not os.path.exists(data_dump):
-            self.idx2triple = self.make_triple_vocab()
-            self.init_data(data_name)
-        
-        self.data = zarr.open(data_dump, mode='r') # load zarr dump
-        self.idx2word = OrderedDict([(v, k) for k, v in self.word2idx.items()])
-        self.triple_dict = self.make_triple_dict()
-        self.entity_lst = self.entidx2wordidx.values()
-        self.rd = redis.StrictRedis()
-        
+    @property
+    def word2idx(self):
+        return self.vocab['word2idx']
+
+    @property
+    def entidx2wordidx(self):
+        return self.vocab['entidx2wordidx']
+
+    @cached_property
+    def idx2word(self):
+        return OrderedDict([(v, k) for k, v in self.word2idx.items()])
+
+    @cached_property
+    def rel2idx(self):
+        return self.make_rel_vocab()
+
+    @cached_property
+    def idx2rel(self):
+        return {val: key for key, val in self.rel2idx.items()}
+
+    @cached_property
+    def triple_dict(self):
+        return self.make_triple_dict()
+
+    @cached_property
+    def entity_lst(self):
+        return set(self.entidx2wordidx.values())
+
+    @cached_property
+    def rd(self):
+        import redis
+        return redis.StrictRedis()
 
     def init_vocab(self):
         # First add DEFAULT_VOCAB
         # idx of each word/entity: glove에서의 idx + 5
-        self.word2idx = OrderedDict([*zip(DEFAULT_VOCAB, range(len(DEFAULT_VOCAB)))])
+        word2idx = OrderedDict([*zip(DEFAULT_VOCAB, range(len(DEFAULT_VOCAB)))])
         
         # Then add Glove vocabs (30000)
         with open(f'{self.data_path}/glove.840B.300d.txt', 'r') as glove_f:
@@ -125,48 +165,63 @@ class CommonsenseDialDataset(torch.utils.data.Dataset):
                 if i >= self.args.n_glove_vocab:
                     break
                 k = line.split()[0]
-                self.word2idx[k] = len(self.word2idx)
+                word2idx[k] = len(word2idx)
 
         # Now add entity vocab that are not in glove
-        self.entidx2wordidx = {} # maps entity idx in 'resources.txt' to word idx
+        entidx2wordidx = {} # maps entity idx in 'resources.txt' to word idx
         raw_dict = open(f'{self.data_path}/resource.txt', 'r').read()
         raw_dict = literal_eval(raw_dict)
         for ent, idx in raw_dict['dict_csk_entities'].items():
-            if ent not in self.word2idx:
-                self.word2idx[ent] = len(self.word2idx)
-            self.entidx2wordidx[idx] = self.word2idx[ent]
+            if ent not in word2idx:
+                word2idx[ent] = len(word2idx)
+            entidx2wordidx[idx] = word2idx[ent]
 
         # Store vocab
-        print(f'Vocab size: {len(self.word2idx)}')
-        vocab = {'word2idx': self.word2idx,
-                'entidx2wordidx': self.entidx2wordidx}
+        print(f'Vocab size: {len(word2idx)}')
+        vocab = {'word2idx': word2idx,
+                'entidx2wordidx': entidx2wordidx}
         with open(f'{self.data_path}/vocab.pkl', 'wb') as df:
             pickle.dump(vocab, df)
+        return vocab
         
             
     def init_data(self, data_name, n_chunk=1024):
+        import zarr
+        import jsonlines
+        from tqdm import tqdm
+        from pathos.helpers import mp
+        from pathos.multiprocessing import ProcessingPool as Pool
         print(f'Initializing {data_name} data...')
 
+        # process_file runs in pool workers: it closes over these (not self), so only they are sent
+        args, word2idx, rel2idx, entidx2wordidx = self.args, self.word2idx, self.rel2idx, self.entidx2wordidx
+        idx2triple = self.make_triple_vocab()
+        n_word = args.n_glove_vocab + len(DEFAULT_VOCAB)
+
+        def get_word_idx(word):
+            res = word2idx.get(word, UNK_IDX)
+            return res if res < n_word else UNK_IDX
+
         def transform_triple_to_hrt(triple_idx):
             """ Transforms triple-idx (as a whole) to h/r/t format """
             if triple_idx == -1: # for response_triple
                 return NAF_TRIPLE
-            triple = self.idx2triple[triple_idx]
+            triple = idx2triple[triple_idx]
             h, r, t = triple.split(', ')
-            return [self.word2idx[h], self.rel2idx[r], self.word2idx[t]]
+            return [word2idx[h], rel2idx[r], word2idx[t]]
 
         def process_file(root, inp):
             start_i, filename = inp
             n_sample = line_count(filename)
             
-            post = np.zeros((n_sample, self.args.max_sentence_len), dtype=np.int32)
+            post = np.zeros((n_sample, args.max_sentence_len), dtype=np.int32)
             post_length = np.zeros((n_sample), dtype=np.int32) # valid length (without pad)
-            response = np.zeros((n_sample, self.args.max_sentence_len), dtype=np.int32)
+            response = np.zeros((n_sample, args.max_sentence_len), dtype=np.int32)
             response_length = np.zeros((n_sample), dtype=np.int32)
-            # post_triple = np.zeros((n_sample, self.args.max_sentence_len), dtype=np.int32)
-            triple = np.zeros((n_sample, self.args.max_sentence_len, self.args.max_triple_len, 3), dtype=np.int32)
-            entity = np.zeros((n_sample, self.args.max_sentence_len, self.args.max_triple_len), dtype=np.int32)
-            response_triple = np.zeros((n_sample, self.args.max_sentence_len, 3), dtype=np.int32)
+            # post_triple = np.zeros((n_sample, args.max_sentence_len), dtype=np.int32)
+            triple = np.zeros((n_sample, args.max_sentence_len, args.max_triple_len, 3), dtype=np.int32)
+            entity = np.zeros((n_sample, args.max_sentence_len, args.max_triple_len), dtype=np.int32)
+            response_triple = np.zeros((n_sample, args.max_sentence_len, 3), dtype=np.int32)
 
             max_post_len, max_response_len, max_triple_len = 0, 0, 0
 
@@ -183,14 +238,14 @@ class CommonsenseDialDataset(torch.utils.data.Dataset):
 
                     all_triples = [line['all_triples'][i-1] if i > 0 else [-1] for i in line['post_triples']]
 
-                    post[i, :pl] = [SOS_IDX] + [self.get_word_idx(p) for p in line['post']] + [EOS_IDX]
-                    response[i, :rl] = [SOS_IDX] + [self.get_word_idx(r) for r in line['response']] + [EOS_IDX]
+                    post[i, :pl] = [SOS_IDX] + [get_word_idx(p) for p in line['post']] + [EOS_IDX]
+                    response[i, :rl] = [SOS_IDX] + [get_word_idx(r) for r in line['response']] + [EOS_IDX]
                     # post_triple[i, 1:pl-1] = np.array(line['post_triples']) # [0, 0, 1, 0, 2...]
                     response_triple[i, :rl] = [NAF_TRIPLE] + [transform_triple_to_hrt(rt) for rt in line['response_triples']] + [NAF_TRIPLE]
 
                     # put NAF_TRIPLE/entity at index 0
-                    triple[i] = pad_2d([[NAF_TRIPLE]] + [[transform_triple_to_hrt(t) for t in triples] for triples in all_triples] + [[NAF_TRIPLE]], length=(self.args.max_sentence_len, self.args.max_triple_len, 3))
-                    entity[i] = pad_2d([[NAF_IDX]] + [[self.entidx2wordidx[e] for e in entities] for entities in line['all_entities']] + [[NAF_IDX]], length=(self.args.max_sentence_len, self.args.max_triple_len))
+                    triple[i] = pad_2d([[NAF_TRIPLE]] + [[transform_triple_to_hrt(t) for t in triples] for triples in all_triples] + [[NAF_TRIPLE]], length=(args.max_sentence_len, args.max_triple_len, 3))
+                    entity[i] = pad_2d([[NAF_IDX]] + [[entidx2wordidx[e] for e in entities] for entities in line['all_entities']] + [[NAF_IDX]], length=(args.max_sentence_len, args.max_triple_len))
 
                 # dump to zarr
                 root['post'][start_i : start_i+n_sample] = post
@@ -270,18 +325,14 @@ class CommonsenseDialDataset(torch.utils.data.Dataset):
     def __getitem__(self, i):
         return {k: v[i:i+self.batch_access] for k, v in self.data.arrays()}
 
-    def get_word_idx(self, word):
-        res = self.word2idx.get(word, UNK_IDX)
-        if res >= self.args.n_glove_vocab + len(DEFAULT_VOCAB):
-            res = UNK_IDX
-        return res
-
-    def retrieve_graph(self, query_idx):
+    def retrieve_graph(self, query_idx, rd=None, graph='CCM'):
+        """ Triples of query_idx from the RedisGraph `graph` of rd (default: the local server, self.rd). """
         if query_idx not in self.entity_lst:
             return [NAF_TRIPLE]
+        rd = rd or self.rd
         query = self.idx2word[query_idx]
-        query_as_head = self.rd.execute_command('GRAPH.QUERY', 'CCM', f"MATCH (x)-[r]->(y) WHERE x.word = '{query}' RETURN r, y.word")
-        query_as_tail = self.rd.execute_command('GRAPH.QUERY', 'CCM', f"MATCH (x)-[r]->(y) WHERE y.word = '{query}' RETURN r, x.word")
+        query_as_head = rd.execute_command('GRAPH.QUERY', graph, f"MATCH (x)-[r]->(y) WHERE x.word = '{query}' RETURN r, y.word")
+        query_as_tail = rd.execute_command('GRAPH.QUERY', graph, f"MATCH (x)-[r]->(y) WHERE y.word = '{query}' RETURN r, x.word")
         query_as_head = [(rel[1][1].decode('utf-8'), ent.decode('utf-8')) for rel, ent in query_as_head[1]]
         query_as_tail = [(rel[1][1].decode('utf-8'), ent.decode('utf-8')) for rel, ent in query_as_tail[1]]
         return [[query_idx, self.rel2idx[r], self.word2idx[e]] for r, e in query_as_head] + [[self.word2idx[e], self.rel2idx[r], query_idx] for r, e in query_as_tail]
@@ -296,6 +347,8 @@ def collate_fn(batch):
     triple = torch.cat([torch.from_numpy(s['triple']) for s in batch], 0) # (bsz, pl, tl, 3) # NOTE: 원래는 pl보다 작지만 (valid-pl-with-triple이므로) 그냥 똑같이 pl로 둠
     entity = torch.cat([torch.from_numpy(s['entity']) for s in batch], 0) # (bsz, pl, tl)
     response_triple = torch.cat([torch.from_numpy(s['response_triple']) for s in batch], 0) # (bsz, rl, 3)
+    # optional sample ids (evaluation), kept aligned through the filtering and sorting below
+    index = torch.cat([torch.from_numpy(s['index']) for s in batch], 0) if 'index' in batch[0] else None
 
     # HACK to resolve NaN issue (data that are all 0)
     is_nonzero = np.where(triple.view(triple.size(0), -1).sum(-1))
@@ -329,6 +382,8 @@ def collate_fn(batch):
         'response_triple': response_triple.long(),
     }
 
+    if index is not None:
+        batched_data['index'] = index[is_nonzero][perm_idx]
     return batched_data
 
 
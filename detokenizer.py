@@ -0,0 +1,34 @@
+import numpy as np
+import torch
+from dataset import SOS_IDX, EOS_IDX, PAD_IDX
+
+
+class Detokenizer:
+    """
+    Batched token ids -> sentences. Words live in a numpy table indexed by token id (unknown ids map to 'UNK'),
+    so a batch is looked up with one fancy index; tokens from the first EOS on, SOS and PAD are masked out
+    with array ops and only the final ' '.join runs per sequence.
+    """
+    def __init__(self, idx2word, unk='UNK'):
+        self.table = np.full(max(idx2word) + 2, unk, dtype=object)
+        for idx, word in idx2word.items():
+            self.table[idx] = word
+        self.unk_idx = len(self.table) - 1
+
+    def __call__(self, ids):
+        return self.decode(ids)
+
+    def decode(self, ids):
+        """ ids: (n, len) int tensor/array or a list of equal-length id lists; returns n sentences. """
+        if torch.is_tensor(ids):
+            ids = ids.detach().cpu().numpy()
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.ndim == 1:
+            ids = ids[None]
+        if len(ids) == 0:
+            return []
+        ids = np.where((ids >= 0) & (ids < self.unk_idx), ids, self.unk_idx)
+        keep = (np.cumsum(ids == EOS_IDX, axis=1) == 0) & (ids != SOS_IDX) & (ids != PAD_IDX)
+        words = self.table[ids[keep]]
+        bounds = np.cumsum(keep.sum(1))[:-1]
+        return [' '.join(sentence) for sentence in np.split(words, bounds)]
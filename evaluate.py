@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+from dataset import CommonsenseDialDataset, collate_fn, EOS_IDX
+from model import build_model
+from criterion import reference_nll
+from detokenizer import Detokenizer
+from utils import to_device
+
+
+def read_done(output_path):
+    """ Ids already written to output_path; a line cut by an interrupted run is truncated away. """
+    done = set()
+    if not os.path.isfile(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        size = 0
+        for line in f:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError
+                done.add(json.loads(line)['id'])
+            except ValueError:
+                break
+            size += len(line)
+        f.truncate(size)
+    return done
+
+
+def iter_batches(data, batch_size, window, done):
+    """
+    Reads the zarr dump `window` rows at a time and yields collated batches of similar post length
+    (sorted within the window), so memory stays bounded by the window whatever the size of the split.
+    Rows already in `done` are skipped; each batch carries the sample ids in batch['index'].
+    """
+    n_lines = len(data['post'])
+    for start in range(0, n_lines, window):
+        end = min(start + window, n_lines)
+        index = np.arange(start, end)
+        keep = np.array([i not in done for i in index], dtype=bool)
+        if not keep.any():
+            continue
+        rows = {key: val[start:end][keep] for key, val in data.arrays()}
+        rows['index'] = index[keep]
+        order = np.argsort(-rows['post_length'], kind='stable')
+        for i in range(0, len(order), batch_size):
+            idx = order[i:i + batch_size]
+            yield collate_fn([{key: val[idx] for key, val in rows.items()}])
+
+
+def entity_usage(tokens, entity):
+    """ (bsz, T) bool: generated token is one of the sample's retrieved entities (the copy path of CCM). """
+    bsz = tokens.size(0)
+    entity = entity.view(bsz, -1).long().sort(-1)[0]
+    pos = torch.searchsorted(entity, tokens).clamp(max=entity.size(1) - 1)
+    return entity.gather(1, pos).eq(tokens) & tokens.gt(EOS_IDX)
+
+
+def evaluate(model, data, detokenizer, output_path, device, batch_size=64, window=4096):
+    """ Generates for every row of the split not yet in output_path, appending one json line per sample. """
+    done = read_done(output_path)
+    if done:
+        print(f'Resuming: {len(done)} samples already in {output_path}')
+    model.eval()
+    n_sample, n_generated, start_time = 0, 0, time.perf_counter()
+    with open(output_path, 'a') as f, torch.no_grad():
+        for batch in iter_batches(data, batch_size, window, done):
+            batch = to_device(batch, device)
+            post, reference = detokenizer(batch['post']), detokenizer(batch['response'])
+            # NLL of the reference from a teacher-forced pass, the texts and entity counts from greedy generation;
+            # neither builds the (bsz, n_out, T) output distributions, only target log-probs and argmax tokens
+            target_log_prob, _, _ = model(batch, reference=True)
+            nll, n_token = reference_nll(target_log_prob, batch['response'][:, 1:])
+            tokens = model.greedy_decode(batch['post'], batch['post_length'], batch['triple'], batch['entity'], model.max_response_len)
+            generated = tokens.eq(EOS_IDX).long().cumsum(1).eq(0)  # before the first EOS; tokens: extended (glove + entity) vocab
+            n_entity = (entity_usage(tokens, batch['entity']) & generated).sum(1)
+            records = zip(batch['index'].tolist(), post, reference, detokenizer(tokens),
+                          nll.tolist(), n_token.tolist(), generated.sum(1).tolist(), n_entity.tolist())
+            for idx, p, r, g, l, n, ng, ne in records:
+                f.write(json.dumps({'id': idx, 'post': p, 'response': r, 'generated': g,
+                                    'nll': l, 'n_token': n, 'n_generated': ng, 'n_entity': ne}) + '\n')
+            f.flush()
+            n_sample += len(batch['index'])
+            n_generated += int(generated.sum())
+    elapsed = time.perf_counter() - start_time
+    return {'samples_per_sec': n_sample / elapsed if n_sample else 0., 'tokens_per_sec': n_generated / elapsed if n_sample else 0.}
+
+
+def summarize(output_path):
+    """ Corpus-level metrics streamed over the output file: perplexity and the share of generated tokens from entities. """
+    nll, n_token, n_generated, n_entity, n_sample = 0., 0, 0, 0, 0
+    with open(output_path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            nll += record['nll']
+            n_token += record['n_token']
+            n_generated += record['n_generated']
+            n_entity += record['n_entity']
+            n_sample += 1
+    return {'n_sample': n_sample, 'perplexity': float(np.exp(nll / max(n_token, 1))),
+            'entity_usage_rate': n_entity / max(n_generated, 1), 'mean_generated_len': n_generated / max(n_sample, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parser')
+    parser.add_argument('--config', type=str, default='best_model.json')
+    parser.add_argument('--model_path', type=str, default='best_model.pt', help='best_model.pt or a checkpoint_*.pt')
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--data_name', type=str, default='test')
+    parser.add_argument('--output', type=str, default='generations.jsonl', help='appended to, and resumed from, if it exists')
+    parser.add_argument('--metrics_path', type=str, default=None, help='default: <output>.metrics.json')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--window', type=int, default=4096, help='rows read and length-sorted at a time')
+    parser.add_argument('--max_response_len', type=int, default=None, help='default: the one of the config')
+    parser.add_argument('--max_sentence_len', type=int, default=150)
+    parser.add_argument('--max_triple_len', type=int, default=50)
+    parser.add_argument('--data_piece_size', type=int, default=10000)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--no_cuda', action='store_true')
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.no_cuda else 'cpu')
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    if args.max_response_len:
+        config['max_response_len'] = args.max_response_len
+    args.n_glove_vocab = config['n_glove_vocab']
+    args.batch_access = 1
+    dataset = CommonsenseDialDataset(args, args.data_dir, args.data_name)
+    model = build_model(config, args.model_path).to(device)
+
+    speed = evaluate(model, dataset.data, Detokenizer(dataset.idx2word), args.output, device, args.batch_size, args.window)
+    metrics = summarize(args.output)
+    metrics.update(speed)
+    print(json.dumps(metrics, indent=2))
+    with open(args.metrics_path or f'{args.output}.metrics.json', 'w') as f:
+        json.dump(metrics, f, indent=2)
@@ -0,0 +1,123 @@
+import argparse
+import torch
+import torch.nn as nn
+from torch import Tensor
+from typing import Tuple
+from dataset import PAD_IDX, NAF_IDX, SOS_IDX, EOS_IDX
+from model import CCMModel, build_model, mix_distribution
+
+
+class ScriptableCCM(CCMModel):
+    """
+    TorchScript-friendly view of a trained CCMModel, split into an encode graph (forward) and a single decode step,
+    plus the whole greedy loop (greedy_decode), so that generation runs in any worker with nothing but torch.
+    Shares (does not copy) the parameters of the wrapped model, and runs the same (scriptable) CCMModel helpers.
+    """
+    def __init__(self, model):
+        nn.Module.__init__(self)
+        self.n_glove_vocab = model.n_glove_vocab
+        self.n_out_vocab = model.n_out_vocab
+        self.gru_layer = model.gru_layer
+        self.word_embedding = model.word_embedding
+        self.entity_embedding = model.entity_embedding
+        self.rel_embedding = model.rel_embedding
+        self.MLP = model.MLP
+        self.Wh = model.Wh
+        self.Wr = model.Wr
+        self.Wt = model.Wt
+        self.gru_enc = model.gru_enc
+        self.gru_dec = model.gru_dec
+        self.Wa = model.Wa
+        self.Wb = model.Wb
+        self.Ub = model.Ub
+        self.Vb = model.Vb
+        self.Wc = model.Wc
+        self.Vo = model.Vo
+        self.Wo = model.Wo
+
+    def forward(self, post, post_length, triple) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
+        """ Encode: returns (post_output, post_mask, static_graph, triple_emb, triple_mask, gru_hidden). """
+        triple_mask = triple.eq(PAD_IDX)
+        head_emb, tail_emb, triple_emb, static_logit, _ = self.embed_triples(triple, triple.new_full((post.size(0), 1, 3), NAF_IDX))
+        post_output, post_mask, static_graph, gru_hidden = self.encode(post, post_length, head_emb, tail_emb, static_logit, triple_mask)
+        return post_output, post_mask, static_graph, triple_emb, triple_mask, gru_hidden
+
+    @torch.jit.export
+    def init_input(self, bsz: int) -> Tensor:
+        """ Decoder input for the first step: SOS word + NAF triple. """
+        device = self.Wo.weight.device
+        sos = torch.full((bsz,), SOS_IDX, dtype=torch.long, device=device)
+        naf = torch.full((bsz,), NAF_IDX, dtype=torch.long, device=device)
+        naf_emb = self.entity_embedding(naf)
+        res_triple_emb = self.MLP(torch.cat([naf_emb, self.rel_embedding(naf), naf_emb], -1))
+        return torch.cat([self.word_embedding(sos), res_triple_emb], -1)  # (bsz, d_embed + 3 * t_embed)
+
+    @torch.jit.export
+    def decode_step(self, response_vector, gru_hidden, post_output, post_mask, static_graph,
+                    triple_emb, triple_mask, entity) -> Tuple[Tensor, Tensor, Tensor]:
+        """ One decoder step: returns (final_dist, entity_dist, gru_hidden). """
+        bsz = post_output.size(0)
+        gru_hidden, final_dist_input, entity_dist = self.recurrent_step(
+            gru_hidden, response_vector, post_output, post_mask, static_graph, self.Ub(static_graph), triple_emb, triple_mask)
+        entity_dist = entity_dist.view(bsz, -1)  # (bsz, pl * tl)
+        generic_index = torch.arange(self.n_glove_vocab, device=entity.device).expand(bsz, -1)
+        final_dist = mix_distribution(self.Wo(final_dist_input), self.Vo(final_dist_input), entity_dist,
+                                      generic_index, entity.view(bsz, -1).long(), self.n_out_vocab)
+        return final_dist, entity_dist, gru_hidden
+
+    @torch.jit.export
+    def next_input(self, final_dist, entity_dist, triple_emb) -> Tuple[Tensor, Tensor]:
+        """ Greedy choice: returns (top1 token in the extended vocab, next decoder input). """
+        top1 = final_dist.max(-1)[1]  # (bsz, )
+        return top1, self.feedback_input(top1, entity_dist, triple_emb)
+
+
+def greedy_decode(module, post, post_length, triple, entity, max_response_len=150):
+    """ Greedy loop of an (optionally scripted) ScriptableCCM, see CCMModel.greedy_decode; returns (bsz, <= max_response_len). """
+    return module.greedy_decode(post, post_length, triple, entity, max_response_len)
+
+
+def check_decode(model, module, bsz=4, pl=12, tl=6, seed=0):
+    """
+    Share of tokens on which module.greedy_decode agrees with CCMModel.forward in eval mode, on random inputs
+    (PAD after the first EOS in both); 1.0 unless the scripted graph and the model drifted apart.
+    """
+    g = torch.Generator().manual_seed(seed)
+    post_length = torch.randint(2, pl + 1, (bsz,), generator=g).sort(descending=True)[0]
+    post_length[0] = pl
+    post = torch.randint(SOS_IDX + 2, model.n_glove_vocab, (bsz, pl), generator=g)
+    post = post.masked_fill(torch.arange(pl).unsqueeze(0) >= post_length.unsqueeze(1), PAD_IDX)
+    triple = torch.stack([torch.randint(1, model.n_out_vocab, (bsz, pl, tl), generator=g),
+                          torch.randint(1, model.n_rel_vocab, (bsz, pl, tl), generator=g),
+                          torch.randint(1, model.n_out_vocab, (bsz, pl, tl), generator=g)], -1)
+    entity = triple[:, :, :, 2]
+    batch = {'post': post, 'post_length': post_length, 'triple': triple, 'entity': entity,
+             'response': torch.full((bsz, 2), SOS_IDX, dtype=torch.long), 'response_triple': torch.full((bsz, 2, 3), NAF_IDX, dtype=torch.long)}
+    model.eval()
+    with torch.no_grad():
+        expected = model(batch)[0].max(1)[1]
+        tokens = greedy_decode(module, post, post_length, triple, entity, model.max_response_len)
+    is_eos = expected.eq(EOS_IDX).long()
+    expected = expected.masked_fill((is_eos.cumsum(1) - is_eos).gt(0), PAD_IDX)  # after the first EOS
+    if expected.size() != tokens.size():
+        return 0.
+    return float(expected.eq(tokens).float().mean())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parser')
+    parser.add_argument('--config', type=str, default='best_model.json')
+    parser.add_argument('--model_path', type=str, default='best_model.pt')
+    parser.add_argument('--save_path', type=str, default='ccm_script.pt')
+    parser.add_argument('--check', action='store_true', help='compare the greedy tokens of the scripted graph with CCMModel')
+    args = parser.parse_args()
+
+    model = build_model(args.config, args.model_path).eval()
+    assert not model.args.baseline, 'Only CCMModel has an exported graph'
+    scripted = torch.jit.script(ScriptableCCM(model))
+    if args.check:
+        agreement = check_decode(model, scripted)
+        print(f'Greedy tokens agreeing with CCMModel: {agreement:.2%}')
+        assert agreement == 1., 'the scripted graph drifted from CCMModel'
+    scripted.save(args.save_path)
+    print(f'Saved the scripted model in {args.save_path}')
@@ -9,8 +9,6 @@ import numpy as np
 
 from utils import line_count
 
-import ipdb
-
 rd = redis.StrictRedis()
 
 raw_dict = open('data/resource.txt', 'r').read()
@@ -1,23 +1,20 @@
 import os
 from ast import literal_eval
-from tqdm import tqdm
-import jsonlines
-import redis
-from fuzzywuzzy import process, fuzz
 
-import ipdb
 
-def store_graph(rd, triples):
+def store_graph(rd, triples, graph='CCM'):
+    from tqdm import tqdm
     print('Storing triples as RedisGraph...')
     for triple in tqdm(triples):
         head, rel, tail = triple.split(", ")
-        rd.execute_command('GRAPH.QUERY', 'CCM', f"MERGE ({{word: '{head}'}})")
-        rd.execute_command('GRAPH.QUERY', 'CCM', f"MERGE ({{word: '{tail}'}})")
-        rd.execute_command('GRAPH.QUERY', 'CCM', f"MATCH (x), (y) WHERE x.word = '{head}' AND y.word = '{tail}' CREATE (x)-[:{rel}]->(y)")
+        rd.execute_command('GRAPH.QUERY', graph, f"MERGE ({{word: '{head}'}})")
+        rd.execute_command('GRAPH.QUERY', graph, f"MERGE ({{word: '{tail}'}})")
+        rd.execute_command('GRAPH.QUERY', graph, f"MATCH (x), (y) WHERE x.word = '{head}' AND y.word = '{tail}' CREATE (x)-[:{rel}]->(y)")
 
 
 def retrieve_graph(rd, query, query_as_head=True, fuzzy=False, entity_lst=None):
     if fuzzy and entity_lst is not None:
+        from fuzzywuzzy import process, fuzz
         # Fuzzy string match
         query = process.extractOne(query, entity_lst, scorer=fuzz.token_sort_ratio)[0]
     print(query)
@@ -29,6 +26,7 @@ def retrieve_graph(rd, query, query_as_head=True, fuzzy=False, entity_lst=None):
     
 
 if __name__ == '__main__':
+    import redis
     rd = redis.StrictRedis()
 
     raw_dict = open('data/resource.txt', 'r').read()
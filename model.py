@@ -1,5 +1,7 @@
 import csv
 import argparse
+import json
+import math
 import random
 import os
 import torch
@@ -7,15 +9,19 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.init import kaiming_uniform_
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
-import pandas as pd
+from torch.utils.checkpoint import checkpoint
 import numpy as np
-from torch_scatter import scatter_add
+from typing import List
 from dataset import DEFAULT_VOCAB, PAD_IDX, NAF_IDX, UNK_IDX, SOS_IDX, EOS_IDX
 
+MODEL_CONFIG_KEYS = ['d_embed', 't_embed', 'hidden', 'n_glove_vocab', 'gru_layer', 'gru_hidden',
+                     'teacher_forcing', 'max_response_len']
+
 
 def get_pretrained_glove(path, n_word=30000):
     saved_glove = path.replace('.txt', '.pt')
     if not os.path.isfile(saved_glove):
+        import pandas as pd
         print('Reading pretrained glove...')
         words = pd.read_csv(path, sep=" ", index_col=0, header=None, quoting=csv.QUOTE_NONE, nrows=n_word)
         # def get_vec(w):
@@ -33,6 +39,7 @@ def get_pretrained_glove(path, n_word=30000):
 def get_pretrained(label_path, weight_path, idx2word, dim=100):
     saved_weight = weight_path.replace('.txt', '.pt')
     if not os.path.isfile(saved_weight):
+        import pandas as pd
         labels = [label for label in open(label_path, 'r').read().split('\n') if label]
         entity = pd.read_csv(weight_path, sep="\t", header=None, quoting=csv.QUOTE_NONE)
         entity.index = labels
@@ -64,29 +71,113 @@ def get_pad_mask(lengths, max_length):
     return mask
 
 
+def get_model_config(args, dataset=None):
+    """ Small json-serializable config from which a model can be rebuilt without the dataset. """
+    config = {key: getattr(args, key) for key in MODEL_CONFIG_KEYS}
+    config['baseline'] = getattr(args, 'baseline', False)
+    if dataset is not None:
+        config['n_out_vocab'] = len(dataset.idx2word)
+        config['n_rel_vocab'] = len(dataset.idx2rel)
+    return config
+
+
+def build_model(config, weight_path=None, map_location='cpu'):
+    """ Builds CCMModel/Baseline from a config (dict or json path) without GloVe, TransE or the dataset; weight_path is best_model.pt or a checkpoint. """
+    if isinstance(config, str):
+        with open(config, 'r') as f:
+            config = json.load(f)
+    args = argparse.Namespace(**config)
+    if args.baseline:
+        model = Baseline(args, pretrained=False)
+    else:
+        model = CCMModel(args, n_out_vocab=args.n_out_vocab, n_rel_vocab=args.n_rel_vocab)
+    if weight_path is not None:
+        state_dict = torch.load(weight_path, map_location=map_location)
+        if 'model' in state_dict and 'optimizer' in state_dict:
+            state_dict = state_dict['model']  # a full checkpoint (saver.CheckpointSaver)
+        # strip the DDP wrapper prefix
+        state_dict = {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+    return model
+
+
+def sample_output_vocab(response, n_glove_vocab, n_sample, extra=None):
+    """
+    Candidate output vocab for sampled-softmax training: specials, every target word of the batch,
+    n_sample log-uniform (Zipfian, GloVe is ordered by frequency) negatives and optional extra ids (e.g. entities).
+    Returns (sorted vocab ids, sorted glove ids among them, logit correction for the glove ids).
+    """
+    device = response.device
+    sampled = torch.exp(torch.rand(n_sample, device=device) * math.log(n_glove_vocab + 1)).long() - 1
+    sampled = sampled.clamp(0, n_glove_vocab - 1)
+    vocab = [torch.arange(len(DEFAULT_VOCAB), device=device), response.reshape(-1), sampled]
+    if extra is not None:
+        vocab.append(extra.reshape(-1).long())
+    vocab = torch.unique(torch.cat(vocab, 0))
+    glove_vocab = vocab[vocab < n_glove_vocab]
+
+    # log-Q correction for sampled negatives; true targets are kept as they are
+    is_target = torch.zeros(n_glove_vocab, dtype=torch.bool, device=device)
+    is_target[response.reshape(-1)] = True
+    log_q = torch.log(torch.log((glove_vocab + 2).float() / (glove_vocab + 1).float()) / math.log(n_glove_vocab + 1) * n_sample)
+    correction = log_q.masked_fill(is_target[glove_vocab], 0)
+    return vocab, glove_vocab, correction
+
+
+def mix_distribution(generic_logit, pointer_logit, entity_dist, generic_index, entity_index, n_out: int):
+    """ Pointer-generator mixture over the output vocab: (bsz, n_out) probabilities. """
+    generic_dist = F.softmax(generic_logit, -1) # (bsz, n_vocab)
+    pointer_prob = torch.sigmoid(pointer_logit)
+    dists = torch.cat([(1 - pointer_prob) * generic_dist, pointer_prob * entity_dist], -1)
+    indices = torch.cat([generic_index, entity_index], -1)
+    return dists.new_zeros((dists.size(0), n_out)).scatter_add_(1, indices, dists)
+
+
 class CCMModel(nn.Module):
-    def __init__(self, args, dataset):
+    """
+    The helpers used by greedy decoding (embed_triples, encode, recurrent_step, feedback_input, greedy_decode) are
+    TorchScript-compatible: export.ScriptableCCM scripts them as they are.
+    """
+    def __init__(self, args, dataset=None, n_out_vocab=None, n_rel_vocab=None):
+        """ Pretrained GloVe/TransE weights are loaded only when the dataset is given. """
         super().__init__()
         self.args = args
         self.dataset = dataset
         self.n_glove_vocab = args.n_glove_vocab + len(DEFAULT_VOCAB) # glove only
-        self.n_out_vocab = len(self.dataset.idx2word)
+        self.n_out_vocab = len(self.dataset.idx2word) if dataset is not None else n_out_vocab
+        self.n_rel_vocab = len(self.dataset.idx2rel) if dataset is not None else n_rel_vocab
         self.gru_layer = args.gru_layer
         self.t_embed = args.t_embed
         self.teacher_forcing = args.teacher_forcing
         self.max_response_len = args.max_response_len
-
-        self.word_embedding = nn.Embedding.from_pretrained(
-            get_pretrained_glove(path=f'{args.data_dir}/glove.840B.300d.txt', n_word=args.n_glove_vocab),
-            freeze=False, padding_idx=PAD_IDX) # specials: pad, unk, naf_h/t
-
-        self.entity_embedding = nn.Embedding.from_pretrained(
-            get_pretrained(label_path=f'{args.data_dir}/entity.txt', weight_path=f'{args.data_dir}/entity_transE.txt', idx2word=self.dataset.idx2word),
-            freeze=False, padding_idx=PAD_IDX)
-
-        self.rel_embedding = nn.Embedding.from_pretrained(
-            get_pretrained(label_path=f'{args.data_dir}/relation.txt', weight_path=f'{args.data_dir}/relation_transE.txt', idx2word=self.dataset.idx2rel),
-            freeze=False, padding_idx=PAD_IDX)
+        self.unique_triple = getattr(args, 'unique_triple', False)
+        self.sampled_softmax = getattr(args, 'sampled_softmax', 0)
+        self.fused_loss = getattr(args, 'fused_loss', False)
+        self.checkpoint_segment = getattr(args, 'checkpoint_segment', 0)
+        self.profiler = None  # optional profiler.PhaseProfiler, set by the trainer
+        sparse = getattr(args, 'sparse_embedding', False)
+        if self.sampled_softmax and self.fused_loss:
+            raise ValueError('--sampled_softmax and --fused_loss are exclusive')
+        if self.checkpoint_segment and self.teacher_forcing < 1:
+            # only the teacher-forced decoder is checkpointed: it would silently keep every activation
+            raise ValueError('--checkpoint_segment needs --teacher_forcing 1')
+
+        if dataset is not None:
+            self.word_embedding = nn.Embedding.from_pretrained(
+                get_pretrained_glove(path=f'{args.data_dir}/glove.840B.300d.txt', n_word=args.n_glove_vocab),
+                freeze=False, padding_idx=PAD_IDX, sparse=sparse) # specials: pad, unk, naf_h/t
+
+            self.entity_embedding = nn.Embedding.from_pretrained(
+                get_pretrained(label_path=f'{args.data_dir}/entity.txt', weight_path=f'{args.data_dir}/entity_transE.txt', idx2word=self.dataset.idx2word),
+                freeze=False, padding_idx=PAD_IDX, sparse=sparse)
+
+            self.rel_embedding = nn.Embedding.from_pretrained(
+                get_pretrained(label_path=f'{args.data_dir}/relation.txt', weight_path=f'{args.data_dir}/relation_transE.txt', idx2word=self.dataset.idx2rel),
+                freeze=False, padding_idx=PAD_IDX, sparse=sparse)
+        else:
+            self.word_embedding = nn.Embedding(self.n_glove_vocab, args.d_embed, padding_idx=PAD_IDX, sparse=sparse)
+            self.entity_embedding = nn.Embedding(self.n_out_vocab, args.t_embed, padding_idx=PAD_IDX, sparse=sparse)
+            self.rel_embedding = nn.Embedding(self.n_rel_vocab, args.t_embed, padding_idx=PAD_IDX, sparse=sparse)
 
         self.MLP = nn.Linear(3 * args.t_embed, 3 * args.t_embed)
         self.Wh = nn.Linear(args.t_embed, args.hidden)
@@ -109,10 +200,86 @@ class CCMModel(nn.Module):
             ret = self.dataset.retrieve_graph(q.item())
             out.append(ret)
             
-    def forward(self, batch):
+    def embed_triples(self, triple, response_triple):
+        """ Returns head/tail embeddings, MLP triple embeddings and static logits of post triples, and response triple embeddings. """
+        head_emb = self.entity_embedding(triple[:, :, :, 0])  # (bsz, pl, tl, t_embed)
+        rel_emb = self.rel_embedding(triple[:, :, :, 1]) # (bsz, pl, tl, t_embed)
+        tail_emb = self.entity_embedding(triple[:, :, :, 2])  # (bsz, pl, tl, t_embed)
+        triple_emb = self.MLP(torch.cat([head_emb, rel_emb, tail_emb], 3))  # (bsz, pl, tl, 3 * t_embed)
+        static_logit = (self.Wr(rel_emb) * torch.tanh(self.Wh(head_emb) + self.Wt(tail_emb))).sum(-1, keepdim=False)  # (bsz, pl, tl)
+
+        res_head_emb = self.entity_embedding(response_triple[:, :, 0])  # (bsz, rl, t_embed)
+        res_rel_emb = self.rel_embedding(response_triple[:, :, 1])  # (bsz, rl, t_embed)
+        res_tail_emb = self.entity_embedding(response_triple[:, :, 2])  # (bsz, rl, t_embed)
+        res_triple_emb = self.MLP(torch.cat([res_head_emb, res_rel_emb, res_tail_emb], 2))  # (bsz, rl, 3 * t_embed)
+        return head_emb, tail_emb, triple_emb, static_logit, res_triple_emb
+
+    def embed_unique_triples(self, triple, response_triple):
+        """
+        Same outputs as embed_triples, but embeddings, MLP and Wh/Wr/Wt run once per unique triple of the batch
+        (post and response triples together) and are gathered back; gradients accumulate through the gather.
+        """
+        bsz, pl, tl, _ = triple.size()
+        rl = response_triple.size(1)
+        n_post = bsz * pl * tl
+        uniq, inverse = torch.unique(torch.cat([triple.view(-1, 3), response_triple.reshape(-1, 3)], 0), dim=0, return_inverse=True)
+        u_head_emb = self.entity_embedding(uniq[:, 0])  # (n_uniq, t_embed)
+        u_rel_emb = self.rel_embedding(uniq[:, 1])  # (n_uniq, t_embed)
+        u_tail_emb = self.entity_embedding(uniq[:, 2])  # (n_uniq, t_embed)
+        u_triple_emb = self.MLP(torch.cat([u_head_emb, u_rel_emb, u_tail_emb], -1))  # (n_uniq, 3 * t_embed)
+        u_static_logit = (self.Wr(u_rel_emb) * torch.tanh(self.Wh(u_head_emb) + self.Wt(u_tail_emb))).sum(-1)  # (n_uniq,)
+
+        post_inverse, res_inverse = inverse[:n_post], inverse[n_post:]
+        head_emb = u_head_emb[post_inverse].view(bsz, pl, tl, -1)
+        tail_emb = u_tail_emb[post_inverse].view(bsz, pl, tl, -1)
+        triple_emb = u_triple_emb[post_inverse].view(bsz, pl, tl, -1)
+        static_logit = u_static_logit[post_inverse].view(bsz, pl, tl)
+        res_triple_emb = u_triple_emb[res_inverse].view(bsz, rl, -1)
+        return head_emb, tail_emb, triple_emb, static_logit, res_triple_emb
+
+    def encode(self, post, post_length, head_emb, tail_emb, static_logit, triple_mask):
+        """ Static graph attention over the post triples and the GRU encoder: returns (post_output, post_mask, static_graph, gru_hidden). """
+        post_mask = post.eq(PAD_IDX)
+        post_emb = self.word_embedding(post)  # (bsz, pl, d_embed)
+
+        # Static Graph
+        ent = torch.cat([head_emb, tail_emb], -1)  # (bsz, pl, tl, 2 * t_embed)
+        static_logit = static_logit.masked_fill(triple_mask[:, :, :, 0], -float('inf'))
+        static_logit = static_logit.masked_fill(post_mask.unsqueeze(-1), 0.)
+        static_attn = F.softmax(static_logit, dim=-1)  # (bsz, pl, tl) # TODO: NAN
+        static_graph = (ent * static_attn.unsqueeze(-1)).sum(-2)  # (bsz, pl, 2 * t_embed) / gi
+        post_input = torch.cat([post_emb, static_graph], -1)  # (bsz, pl, d_emb + 2 * t_embed)
+
+        # Encoder (lengths are read on the host: a no-op for the trainer's batches)
+        packed_post_input = pack_padded_sequence(post_input, post_length.cpu(), batch_first=True)
+        packed_post_output, gru_hidden = self.gru_enc(packed_post_input)
+        post_output, _ = pad_packed_sequence(packed_post_output, batch_first=True)  # (bsz, pl, go)
+        return post_output, post_mask, static_graph, gru_hidden
+
+    @staticmethod
+    def target_log_prob(generic_logit, pointer_logit, entity_dist, entity_index, target):
+        """
+        log p(target) of the pointer-generator mixture, computed in log space from the generic logits,
+        pointer logit and entity attention without building the (bsz, n_out) distribution.
+        Targets are glove ids (entity-only ids are mapped to UNK), so both branches can produce them.
+        """
+        target = target.unsqueeze(-1)  # (bsz, 1)
+        generic_log_prob = generic_logit.gather(1, target).squeeze(-1) - torch.logsumexp(generic_logit, -1)
+        copy_prob = (entity_dist * entity_index.eq(target).to(entity_dist.dtype)).sum(-1)
+        pointer_logit = pointer_logit.squeeze(-1)
+        return torch.logsumexp(torch.stack([
+            F.logsigmoid(-pointer_logit) + generic_log_prob,
+            F.logsigmoid(pointer_logit) + torch.log(copy_prob.clamp(min=1e-30))  # log(0) would give NaN gradients
+        ], 0), 0)  # (bsz,)
+
+    def forward(self, batch, reference=False):
+        """
+        Returns (output, pointer_prob, output_vocab); output_vocab is the sampled vocab output is over (sampled-softmax training) or None.
+        reference: teacher-forced over batch['response'] whatever the mode and the teacher_forcing ratio, to score the reference;
+        output is then the (bsz, rl - 1) log-probs of the reference tokens, without building the output distributions.
+        """
         post = batch['post']
         bsz = post.size()[0]
-        post_mask = post.eq(PAD_IDX)
         post_length = batch['post_length']
         # post_triple = batch['post_triple']
         triple = batch['triple']
@@ -120,134 +287,261 @@ class CCMModel(nn.Module):
         entity = batch['entity']
         device = post.device
 
-        post_emb = self.word_embedding(post)  # (bsz, pl, d_embed)
-        head, rel, tail = torch.split(triple, 1, 3)  # (bsz, pl, tl)
-        head_emb = self.entity_embedding(head.squeeze(-1))  # (bsz, pl, tl, t_embed)
-        rel_emb = self.rel_embedding(rel.squeeze(-1)) # (bsz, pl, tl, t_embed)
-        tail_emb = self.entity_embedding(tail.squeeze(-1))  # (bsz, pl, tl, t_embed)
-        triple_emb = self.MLP(torch.cat([head_emb, rel_emb, tail_emb], 3))  # (bsz, pl, tl, 3 * t_embed)
-
-
         response = batch['response']
         response[response >= self.n_glove_vocab] = UNK_IDX
         rl = response.size()[1]
         response_triple = batch['response_triple']
-        if not self.training:
+        if not self.training and not reference:
             response = torch.ones((bsz, 1), dtype=torch.long, device=device) * SOS_IDX
             response_triple = torch.ones((bsz, 1, 3), dtype=torch.long, device=device) * NAF_IDX
         response_emb = self.word_embedding(response)  # (bsz, rl, d_embed)
-        res_head, res_rel, res_tail = torch.split(response_triple, 1, 2)  # (bsz, rl, 1)
-        res_head_emb = self.entity_embedding(res_head.squeeze(-1))  # (bsz, rl, t_embed)
-        res_rel_emb = self.rel_embedding(res_rel.squeeze(-1))  # (bsz, rl, t_embed)
-        res_tail_emb = self.entity_embedding(res_tail.squeeze(-1))  # (bsz, rl, t_embed)
-        res_triple_emb = self.MLP(torch.cat([res_head_emb, res_rel_emb, res_tail_emb], 2))  # (bsz, rl, 3 * t_embed)
-
-        # Static Graph
-        ent = torch.cat([head_emb, tail_emb], -1)  # (bsz, pl, tl, 2 * t_embed)
-        # mask = get_pad_mask(post_triple.max(-1)[0], ent.size(1)).to(device)
-        # ent.data.masked_fill_(mask.view(*mask.size(), 1, 1), 0)
-        static_logit = (self.Wr(rel_emb) * torch.tanh(self.Wh(head_emb) + self.Wt(tail_emb))).sum(-1, keepdim=False)  # (bsz, pl, tl)
-        static_logit.data.masked_fill_(triple_mask[:, :, :, 0], -float('inf'))
-        static_logit.data.masked_fill_(post_mask.unsqueeze(-1), 0)
-        static_attn = F.softmax(static_logit, dim=-1)  # (bsz, pl, tl) # TODO: NAN
-        static_graph = (ent * static_attn.unsqueeze(-1)).sum(-2)  # (bsz, pl, 2 * t_embed) / gi
-        # post_triples = static_graph.gather(1, post_triple.unsqueeze(-1).expand_as(static_graph))
-        post_input = torch.cat([post_emb, static_graph], -1)  # (bsz, pl, d_emb + 2 * t_embed)
 
-        # Encoder
-        packed_post_input = pack_padded_sequence(post_input, lengths=post_length.tolist(), batch_first=True)
-        packed_post_output, gru_hidden = self.gru_enc(packed_post_input)
-        post_output, _ = pad_packed_sequence(packed_post_output, batch_first=True)  # (bsz, pl, go)
-        gru_state = gru_hidden.transpose(0, 1).reshape(bsz, 1, -1)
+        if self.unique_triple:
+            head_emb, tail_emb, triple_emb, static_logit, res_triple_emb = self.embed_unique_triples(triple, response_triple)
+        else:
+            head_emb, tail_emb, triple_emb, static_logit, res_triple_emb = self.embed_triples(triple, response_triple)
+
+        # Static graph and encoder
+        post_output, post_mask, static_graph, gru_hidden = self.encode(post, post_length, head_emb, tail_emb, static_logit, triple_mask)
+
+        # Output head: exact over (glove + entity) vocab, or a sampled candidate vocab while training
+        if self.training and self.sampled_softmax and not reference:
+            out_vocab, glove_vocab, correction = sample_output_vocab(response, self.n_glove_vocab, self.sampled_softmax, extra=entity)
+            Wo_weight, Wo_bias = self.Wo.weight[glove_vocab], self.Wo.bias[glove_vocab] - correction
+            vocab2pos = torch.zeros(self.n_out_vocab, dtype=torch.long, device=device)
+            vocab2pos[out_vocab] = torch.arange(out_vocab.size(0), device=device)
+            entity_index = vocab2pos[entity.view(bsz, -1).long()]
+            n_generic, n_out = glove_vocab.size(0), out_vocab.size(0)
+        else:
+            out_vocab, Wo_weight, Wo_bias = None, None, None
+            entity_index = entity.view(bsz, -1).long()
+            n_generic, n_out = self.n_glove_vocab, self.n_out_vocab
+        generic_index = torch.arange(n_generic, device=device).repeat(bsz, 1)
+
+        if self.profiler:
+            self.profiler.lap('encoder')
 
         # Decoder
+        fused = (self.training and self.fused_loss) or reference  # target log-probs (and pointer logits) only
+        teacher_forced = reference or (self.training and self.teacher_forcing >= 1)  # no feedback: the output head can run after the loop
+        static_graph_proj = self.Ub(static_graph)  # (bsz, pl, hidden), independent of the decoder state
+        response_input = torch.cat([response_emb, res_triple_emb], -1)  # (bsz, rl, d_embed + 3 * t_embed)
+        encoded = (post_output, post_mask, static_graph, static_graph_proj, triple_emb, triple_mask)
+        if teacher_forced:
+            head = (out_vocab, Wo_weight, Wo_bias, generic_index, entity_index, n_out, fused)
+            if self.checkpoint_segment and self.training:
+                return (*self.checkpointed_decode(gru_hidden, response_input, response, encoded, head), out_vocab)
+            final_dist_inputs, entity_dists = [], []
+            for t in range(rl - 1):
+                gru_hidden, final_dist_input, entity_dist = self.recurrent_step(gru_hidden, response_input[:, t], *encoded)
+                final_dist_inputs.append(final_dist_input)
+                entity_dists.append(entity_dist.view(bsz, -1))
+            return (*self.teacher_forced_output(torch.stack(final_dist_inputs, 1), torch.stack(entity_dists, 1), response[:, 1:], *head), out_vocab)
+
         dec_logits = []
         pointer_probs = []
         t = 0
-        response_input = torch.cat([response_emb, res_triple_emb], -1)  # (bsz, rl, d_embed + 3 * t_embed)
         response_vector = response_input[:, 0]  # (bsz, d_embed + 3 * t_embed)
         finished_index = torch.zeros(bsz, device=device)
         while True:
-            # c
-            context_logit = (post_output * self.Wa(gru_state)).sum(-1)  # (bsz, pl)
-            context_logit.data.masked_fill_(post_mask, -float('inf'))
-            context_attn = F.softmax(context_logit, dim=-1)  # (bsz, pl)
-            context_vector = (post_output * context_attn.unsqueeze(-1)).sum(-2, keepdim=False)  # (bsz, gru_hidden) / c
-
-            # cg
-            dynamic_logit = self.Vb(torch.tanh(self.Wb(gru_state) + self.Ub(static_graph))).squeeze(-1)  # (bsz, pl)
-            dynamic_logit.data.masked_fill_(post_mask, -float('inf'))
-            dynamic_attn = F.softmax(dynamic_logit, dim=-1)  # (bsz, pl)
-            dynamic_graph = (static_graph * dynamic_attn.unsqueeze(-1)).sum(-2)  # (bsz, 2 * t_embed) / cg
-
-            # ck
-            triple_logit = (triple_emb * self.Wc(gru_state).unsqueeze(-2)).sum(-1)  # (bsz, pl, tl)
-            triple_logit.data.masked_fill_(triple_mask[:, :, :, 0], -float('inf'))
-            triple_logit.data.masked_fill_(post_mask.unsqueeze(-1), 0)
-            triple_attn = F.softmax(triple_logit, dim=-1)  # (bsz, pl, tl)
-            triple_tmp = (triple_emb * triple_attn.unsqueeze(-1)).sum(-2, keepdim=False)
-            triple_tmp.data.masked_fill_(post_mask.unsqueeze(-1), 0)
-            triple_vector = (triple_tmp * dynamic_attn.unsqueeze(-1)).sum(-2)  # (bsz, 3 * t_embed)
-
-            dec_input = torch.cat([context_vector, dynamic_graph, triple_vector, response_vector], 1).unsqueeze(
-                -2)  # (bsz, gru_hidden + 8 * t_embed + d_embed)
-            gru_out, gru_hidden = self.gru_dec(dec_input,
-                                               gru_hidden)  # (bsz, 1, gru_hidden) / (2*gru_hidden, bsz) # NOTE: 2-layer..
-            gru_state = gru_hidden.transpose(0, 1).reshape(bsz, 1, -1)
+            gru_hidden, final_dist_input, entity_dist = self.recurrent_step(gru_hidden, response_vector, *encoded)
 
             # pointer-generator logic
-            final_dist_input = torch.cat([gru_state.squeeze(1), context_vector, dynamic_graph, triple_vector], dim=-1) # (bsz, 3*gru_hidden + 5*t_embed)
-            generic_dist = F.softmax(self.Wo(final_dist_input), -1) # (bsz, n_vocab)
-            entity_dist = dynamic_attn.unsqueeze(-1) * triple_attn # (bsz, pl, tl)
-            pointer_prob = torch.sigmoid(self.Vo(final_dist_input))
-            pointer_probs.append(pointer_prob)
-            dists = torch.cat([(1 - pointer_prob) * generic_dist, pointer_prob * entity_dist.view(bsz, -1)], -1) 
-            indices = torch.cat([
-              torch.arange(self.n_glove_vocab).repeat(bsz, 1).to(entity),
-              entity.view(bsz, -1)
-              ], -1)
-            out = dists.new_zeros((bsz, self.n_out_vocab))
-            final_dist = scatter_add(dists, indices.long(), out=out)
-
-            dec_logits.append(final_dist.unsqueeze(0))
+            if out_vocab is None:
+                generic_logit = self.Wo(final_dist_input)
+            else:
+                generic_logit = F.linear(final_dist_input, Wo_weight, Wo_bias)
+            pointer_logit = self.Vo(final_dist_input)
+            if fused:
+                pointer_probs.append(pointer_logit)
+                dec_logits.append(self.target_log_prob(generic_logit, pointer_logit, entity_dist.view(bsz, -1), entity_index, response[:, t + 1]).unsqueeze(0))
+                final_dist = None
+            else:
+                pointer_probs.append(torch.sigmoid(pointer_logit))
+                final_dist = mix_distribution(generic_logit, pointer_logit, entity_dist.view(bsz, -1), generic_index, entity_index, n_out)
+                dec_logits.append(final_dist.unsqueeze(0))
 
             if random.random() < self.teacher_forcing and self.training:
                 response_vector = response_input[:, t + 1] # ground truth
             else:
+                if final_dist is None:
+                    with torch.no_grad():
+                        final_dist = mix_distribution(generic_logit, pointer_logit, entity_dist.view(bsz, -1), generic_index, entity_index, n_out)
                 top1 = final_dist.max(-1)[1]  # (bsz, )
-                top1[top1 >= self.n_glove_vocab] = UNK_IDX
+                if out_vocab is not None:
+                    top1 = out_vocab[top1]
                 finished_index[top1 == EOS_IDX] = 1
-                response_emb = self.word_embedding(top1)  # (bsz, d_embed)
-                top1_triple_idx = entity_dist.view(bsz, -1).max(-1)[1]
-                top1_triple_emb = triple_emb.view(bsz, -1, triple_emb.size(-1))[torch.arange(bsz), top1_triple_idx]
-                response_vector = torch.cat([response_emb, top1_triple_emb], -1)  # (bsz, d_embed + 3 * t_embed)
+                response_vector = self.feedback_input(top1, entity_dist.view(bsz, -1), triple_emb)  # (bsz, d_embed + 3 * t_embed)
             t += 1
             if (self.training and t == rl-1) or \
                     (not self.training and (finished_index.sum() == bsz or t == self.max_response_len)):
                 break
 
+        if fused:
+            # (bsz, rl - 1) target log-probs and pointer logits, see criterion.fused_criterion
+            return torch.cat(dec_logits, 0).transpose(0, 1), torch.cat(pointer_probs, -1), out_vocab
         dec_logits = torch.cat(dec_logits, 0).permute(1, 2, 0)
         pointer_probs = torch.cat(pointer_probs, -1)
-        return dec_logits, pointer_probs
+        return dec_logits, pointer_probs, out_vocab
+
+    def recurrent_step(self, gru_hidden, response_vector, post_output, post_mask, static_graph, static_graph_proj, triple_emb, triple_mask):
+        """ One decoder step up to the output head: returns (gru_hidden, final_dist_input, entity_dist). """
+        bsz = post_output.size(0)
+        gru_state = gru_hidden.transpose(0, 1).reshape(bsz, 1, -1)
+
+        # c
+        context_logit = (post_output * self.Wa(gru_state)).sum(-1).masked_fill(post_mask, -float('inf'))  # (bsz, pl)
+        context_attn = F.softmax(context_logit, dim=-1)  # (bsz, pl)
+        context_vector = (post_output * context_attn.unsqueeze(-1)).sum(-2, keepdim=False)  # (bsz, gru_hidden) / c
+
+        # cg
+        dynamic_logit = self.Vb(torch.tanh(self.Wb(gru_state) + static_graph_proj)).squeeze(-1)  # (bsz, pl)
+        dynamic_logit = dynamic_logit.masked_fill(post_mask, -float('inf'))
+        dynamic_attn = F.softmax(dynamic_logit, dim=-1)  # (bsz, pl)
+        dynamic_graph = (static_graph * dynamic_attn.unsqueeze(-1)).sum(-2)  # (bsz, 2 * t_embed) / cg
+
+        # ck
+        triple_logit = (triple_emb * self.Wc(gru_state).unsqueeze(-2)).sum(-1)  # (bsz, pl, tl)
+        triple_logit = triple_logit.masked_fill(triple_mask[:, :, :, 0], -float('inf'))
+        triple_logit = triple_logit.masked_fill(post_mask.unsqueeze(-1), 0.)
+        triple_attn = F.softmax(triple_logit, dim=-1)  # (bsz, pl, tl)
+        triple_tmp = (triple_emb * triple_attn.unsqueeze(-1)).sum(-2, keepdim=False)
+        triple_tmp = triple_tmp.masked_fill(post_mask.unsqueeze(-1), 0.)
+        triple_vector = (triple_tmp * dynamic_attn.unsqueeze(-1)).sum(-2)  # (bsz, 3 * t_embed)
+
+        dec_input = torch.cat([context_vector, dynamic_graph, triple_vector, response_vector], 1).unsqueeze(
+            -2)  # (bsz, gru_hidden + 8 * t_embed + d_embed)
+        gru_out, gru_hidden = self.gru_dec(dec_input,
+                                           gru_hidden)  # (bsz, 1, gru_hidden) / (2*gru_hidden, bsz) # NOTE: 2-layer..
+        gru_state = gru_hidden.transpose(0, 1).reshape(bsz, -1)
+
+        final_dist_input = torch.cat([gru_state, context_vector, dynamic_graph, triple_vector], dim=-1) # (bsz, 3*gru_hidden + 5*t_embed)
+        entity_dist = dynamic_attn.unsqueeze(-1) * triple_attn # (bsz, pl, tl)
+        return gru_hidden, final_dist_input, entity_dist
+
+    def feedback_input(self, top1, entity_dist, triple_emb):
+        """ Decoder input after emitting top1 (extended vocab ids): its word (entities as UNK) and the most attended triple. """
+        bsz = top1.size(0)
+        word = top1.masked_fill(top1 >= self.n_glove_vocab, UNK_IDX)
+        top1_triple_idx = entity_dist.max(-1)[1]
+        top1_triple_emb = triple_emb.view(bsz, -1, triple_emb.size(-1))[torch.arange(bsz, device=top1.device), top1_triple_idx]
+        return torch.cat([self.word_embedding(word), top1_triple_emb], -1)  # (bsz, d_embed + 3 * t_embed)
+
+    @torch.jit.export
+    def greedy_decode(self, post, post_length, triple, entity, max_response_len: int) -> torch.Tensor:
+        """
+        Greedy decoding as forward in eval mode, keeping only the argmax of each step instead of the (bsz, n_out)
+        distributions: returns (bsz, <= max_response_len) ids in the extended vocab, PAD after the first EOS.
+        """
+        bsz = post.size(0)
+        triple_mask = triple.eq(PAD_IDX)
+        head_emb, tail_emb, triple_emb, static_logit, res_triple_emb = self.embed_triples(triple, triple.new_full((bsz, 1, 3), NAF_IDX))
+        post_output, post_mask, static_graph, gru_hidden = self.encode(post, post_length, head_emb, tail_emb, static_logit, triple_mask)
+        static_graph_proj = self.Ub(static_graph)
+        generic_index = torch.arange(self.n_glove_vocab, device=post.device).expand(bsz, -1)
+        entity_index = entity.view(bsz, -1).long()
+        response_vector = torch.cat([self.word_embedding(post.new_full((bsz,), SOS_IDX)), res_triple_emb[:, 0]], -1)
+        finished = torch.zeros(bsz, dtype=torch.bool, device=post.device)
+        tokens: List[torch.Tensor] = []
+        for _ in range(max_response_len):
+            gru_hidden, final_dist_input, entity_dist = self.recurrent_step(
+                gru_hidden, response_vector, post_output, post_mask, static_graph, static_graph_proj, triple_emb, triple_mask)
+            entity_dist = entity_dist.view(bsz, -1)
+            final_dist = mix_distribution(self.Wo(final_dist_input), self.Vo(final_dist_input), entity_dist, generic_index, entity_index, self.n_out_vocab)
+            top1 = final_dist.max(-1)[1]  # (bsz, )
+            tokens.append(top1.masked_fill(finished, PAD_IDX))
+            finished = finished | top1.eq(EOS_IDX)
+            if bool(finished.all()):
+                break
+            response_vector = self.feedback_input(top1, entity_dist, triple_emb)
+        return torch.stack(tokens, 1)
+
+    def teacher_forced_output(self, final_dist_input, entity_dist, target, out_vocab, Wo_weight, Wo_bias,
+                              generic_index, entity_index, n_out, fused):
+        """ Applies Wo/Vo and the pointer mixture once over (bsz, T) decoder steps; T = target.size(1). """
+        bsz, n_step = target.size()
+        final_dist_input = final_dist_input.reshape(bsz * n_step, -1)  # (bsz * T, 3*gru_hidden + 5*t_embed)
+        entity_dist = entity_dist.reshape(bsz * n_step, -1)  # (bsz * T, pl * tl)
+        entity_index = entity_index.unsqueeze(1).expand(-1, n_step, -1).reshape(bsz * n_step, -1)
+        if out_vocab is None:
+            generic_logit = self.Wo(final_dist_input)
+        else:
+            generic_logit = F.linear(final_dist_input, Wo_weight, Wo_bias)
+        pointer_logit = self.Vo(final_dist_input)  # (bsz * T, 1)
+        if fused:
+            target_log_prob = self.target_log_prob(generic_logit, pointer_logit, entity_dist, entity_index, target.reshape(-1))
+            return target_log_prob.view(bsz, n_step), pointer_logit.view(bsz, n_step)
+        generic_index = generic_index[:1].expand(bsz * n_step, -1)
+        final_dist = mix_distribution(generic_logit, pointer_logit, entity_dist, generic_index, entity_index, n_out)
+        return final_dist.view(bsz, n_step, -1).transpose(1, 2), torch.sigmoid(pointer_logit).view(bsz, n_step)
+
+    def checkpointed_decode(self, gru_hidden, response_input, response, encoded, head):
+        """
+        Teacher-forced decoding in segments of checkpoint_segment steps; the attention intermediates and the
+        output head of a segment are recomputed during backward, only segment boundaries and outputs are kept.
+        """
+        out_vocab, Wo_weight, Wo_bias, generic_index, entity_index, n_out, fused = head
+        bsz = response.size(0)
+        n_step = response.size(1) - 1
+
+        def run_segment(start, end):
+            def segment(gru_hidden, response_input, *encoded):
+                final_dist_inputs, entity_dists = [], []
+                for t in range(start, end):
+                    gru_hidden, final_dist_input, entity_dist = self.recurrent_step(gru_hidden, response_input[:, t], *encoded)
+                    final_dist_inputs.append(final_dist_input)
+                    entity_dists.append(entity_dist.view(bsz, -1))
+                return gru_hidden, torch.stack(final_dist_inputs, 1), torch.stack(entity_dists, 1)
+            return segment
+
+        def output_segment(start, end):
+            def segment(final_dist_input, entity_dist, Wo_weight, Wo_bias):
+                return self.teacher_forced_output(final_dist_input, entity_dist, response[:, start + 1:end + 1], out_vocab,
+                                                  Wo_weight, Wo_bias, generic_index, entity_index, n_out, fused)
+            return segment
+
+        outputs, pointer_outputs = [], []
+        for start in range(0, n_step, self.checkpoint_segment):
+            end = min(start + self.checkpoint_segment, n_step)
+            # non-reentrant: the same decoder/head weights are reused by every segment, which reentrant
+            # checkpointing reports to DDP as ready more than once
+            gru_hidden, final_dist_input, entity_dist = checkpoint(run_segment(start, end), gru_hidden, response_input, *encoded, use_reentrant=False)
+            output, pointer_output = checkpoint(output_segment(start, end), final_dist_input, entity_dist, Wo_weight, Wo_bias, use_reentrant=False)
+            outputs.append(output)
+            pointer_outputs.append(pointer_output)
+        return torch.cat(outputs, -1), torch.cat(pointer_outputs, -1)
 
 
 class Baseline(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, pretrained=True):
         super().__init__()
         self.args = args
         self.n_glove_vocab = args.n_glove_vocab + len(DEFAULT_VOCAB) # glove only
         self.gru_layer = args.gru_layer
         self.teacher_forcing = args.teacher_forcing
         self.max_response_len = args.max_response_len
-
-        self.word_embedding = nn.Embedding.from_pretrained(
-            get_pretrained_glove(path=f'{args.data_dir}/glove.840B.300d.txt', n_word=args.n_glove_vocab),
-            freeze=False, padding_idx=PAD_IDX) # specials: pad, unk, naf_h/t
+        self.sampled_softmax = getattr(args, 'sampled_softmax', 0)
+        self.profiler = None  # optional profiler.PhaseProfiler, set by the trainer
+        sparse = getattr(args, 'sparse_embedding', False)
+        if getattr(args, 'checkpoint_segment', 0):
+            raise ValueError('--checkpoint_segment is only supported by CCMModel')
+
+        if pretrained:
+            self.word_embedding = nn.Embedding.from_pretrained(
+                get_pretrained_glove(path=f'{args.data_dir}/glove.840B.300d.txt', n_word=args.n_glove_vocab),
+                freeze=False, padding_idx=PAD_IDX, sparse=sparse) # specials: pad, unk, naf_h/t
+        else:
+            self.word_embedding = nn.Embedding(self.n_glove_vocab, args.d_embed, padding_idx=PAD_IDX, sparse=sparse)
         self.gru_enc = nn.GRU(args.d_embed, args.gru_hidden, args.gru_layer, batch_first=True)
         self.gru_dec = nn.GRU(args.d_embed, args.gru_hidden, args.gru_layer, batch_first=True)
         self.Wo = nn.Linear(args.gru_hidden, self.n_glove_vocab)
 
-    def forward(self, batch):
+    def forward(self, batch, reference=False):
+        """
+        Returns (output, pointer_prob, output_vocab); output_vocab is the sampled vocab output is over (sampled-softmax training) or None.
+        reference: teacher-forced over batch['response'] whatever the mode and the teacher_forcing ratio, to score the reference;
+        output is then the (bsz, rl - 1) log-probs of the reference tokens, without building the output distributions.
+        """
         post = batch['post']
         post_length = batch['post_length']
         response = batch['response']
@@ -255,16 +549,36 @@ class Baseline(nn.Module):
         device = post.device
         rl = response.size()[1]
 
-        post_emb = self.word_embedding(post)  # (bsz, pl, d_embed)
         response[response >= self.n_glove_vocab] = UNK_IDX
         response_emb = self.word_embedding(response)  # (bsz, rl, d_embed)
 
-        # Encoder
-        packed_post_input = pack_padded_sequence(post_emb, lengths=post_length.tolist(), batch_first=True)
-        packed_post_output, gru_hidden = self.gru_enc(packed_post_input)
-        post_output, _ = pad_packed_sequence(packed_post_output, batch_first=True)  # (bsz, pl, go)
+        gru_hidden = self.encode(post, post_length)
+
+        # Output head: exact, or a sampled candidate vocab while training
+        out_vocab = None
+        if self.training and self.sampled_softmax and not reference:
+            out_vocab, _, correction = sample_output_vocab(response, self.n_glove_vocab, self.sampled_softmax)
+            Wo_weight, Wo_bias = self.Wo.weight[out_vocab], self.Wo.bias[out_vocab] - correction
+
+        if self.profiler:
+            self.profiler.lap('encoder')
 
         # Decoder
+        if reference or (self.training and self.teacher_forcing >= 1):
+            # whole shifted response in one packed GRU call and one Wo projection; padded steps are ignored by the loss
+            dec_length = (batch['response_length'] - 1).clamp(min=1)
+            packed_response_input = pack_padded_sequence(response_emb[:, :rl-1], lengths=dec_length.tolist(), batch_first=True, enforce_sorted=False)
+            packed_gru_out, _ = self.gru_dec(packed_response_input, gru_hidden)
+            gru_out, _ = pad_packed_sequence(packed_gru_out, batch_first=True, total_length=rl-1)  # (bsz, rl - 1, gru_hidden)
+            if reference:
+                logit = self.Wo(gru_out)  # (bsz, rl - 1, n_vocab)
+                return logit.gather(-1, response[:, 1:].unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logit, -1), None, None
+            if out_vocab is None:
+                dec_logits = F.softmax(self.Wo(gru_out), -1)
+            else:
+                dec_logits = F.softmax(F.linear(gru_out, Wo_weight, Wo_bias), -1)
+            return dec_logits.transpose(1, 2), None, out_vocab
+
         dec_logits = []
         t = 0
         finished_index = torch.zeros((bsz,1), device=device)
@@ -272,13 +586,18 @@ class Baseline(nn.Module):
         while True:
             t += 1
             gru_out, gru_hidden = self.gru_dec(response_input, gru_hidden)  # (bsz, 1, gru_hidden) / (2*gru_hidden, bsz) # NOTE: 2-layer..
-            dec_logit = F.softmax(self.Wo(gru_out), -1) # (bsz, n_vocab)
+            if out_vocab is None:
+                dec_logit = F.softmax(self.Wo(gru_out), -1) # (bsz, n_vocab)
+            else:
+                dec_logit = F.softmax(F.linear(gru_out, Wo_weight, Wo_bias), -1)
             dec_logits.append(dec_logit)
 
             if random.random() < self.teacher_forcing and self.training:
                 response_input = response_emb[:, t:t+1] # ground truth
             else:
                 top1 = dec_logit.max(-1)[1]  # (bsz, )
+                if out_vocab is not None:
+                    top1 = out_vocab[top1]
                 top1[top1 >= self.n_glove_vocab] = UNK_IDX
                 finished_index[top1 == EOS_IDX] = 1
                 response_input = self.word_embedding(top1)  # (bsz, d_embed)
@@ -286,7 +605,31 @@ class Baseline(nn.Module):
                     (not self.training and (finished_index.sum() == bsz or t == self.max_response_len)):
                 break
         dec_logits = torch.cat(dec_logits, 1).transpose(1, 2)
-        return dec_logits, None
+        return dec_logits, None, out_vocab
+
+    def encode(self, post, post_length):
+        """ Returns the final hidden state of the GRU encoder. """
+        post_emb = self.word_embedding(post)  # (bsz, pl, d_embed)
+        packed_post_input = pack_padded_sequence(post_emb, lengths=post_length.tolist(), batch_first=True)
+        _, gru_hidden = self.gru_enc(packed_post_input)
+        return gru_hidden
+
+    def greedy_decode(self, post, post_length, triple, entity, max_response_len):
+        """ Greedy decoding as forward in eval mode, keeping only the argmax of each step (see CCMModel.greedy_decode); triple and entity are unused. """
+        bsz = post.size(0)
+        gru_hidden = self.encode(post, post_length)
+        response_input = self.word_embedding(post.new_full((bsz, 1), SOS_IDX))
+        finished = torch.zeros(bsz, dtype=torch.bool, device=post.device)
+        tokens = []
+        for _ in range(max_response_len):
+            gru_out, gru_hidden = self.gru_dec(response_input, gru_hidden)
+            top1 = self.Wo(gru_out[:, 0]).max(-1)[1]  # (bsz, ), the argmax of the softmax of forward
+            tokens.append(top1.masked_fill(finished, PAD_IDX))
+            finished = finished | top1.eq(EOS_IDX)
+            if bool(finished.all()):
+                break
+            response_input = self.word_embedding(top1).unsqueeze(1)
+        return torch.stack(tokens, 1)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='parser')
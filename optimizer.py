@@ -0,0 +1,37 @@
+import torch.nn as nn
+import torch.optim as optim
+
+
+class MultiOptimizer:
+    """ Steps several optimizers as one (e.g. SparseAdam for sparse embeddings and Adam for the rest). """
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def get_optimizer(model, lr, sparse_embedding=False):
+    """ Adam over all parameters; with sparse embeddings, their weights go to SparseAdam instead. """
+    if not sparse_embedding:
+        return optim.Adam(model.parameters(), lr)
+    sparse_params = [module.weight for module in model.modules() if isinstance(module, nn.Embedding) and module.sparse]
+    sparse_ids = {id(param) for param in sparse_params}
+    dense_params = [param for param in model.parameters() if id(param) not in sparse_ids]
+    return MultiOptimizer(optim.SparseAdam(sparse_params, lr), optim.Adam(dense_params, lr))
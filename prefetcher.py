@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+import torch
+from utils import to_device
+
+
+class Prefetcher:
+    """
+    Iterates a DataLoader `depth` batches ahead in a background thread, so that fetching/collating and the
+    host-to-device copy overlap with compute. On CUDA, the (pinned) batch is copied non-blocking on a side stream
+    and the consumer only waits for that copy. Length tensors stay on the host, as in trainer.epoch.
+    fetch_time is the producer's time per epoch, wait_time the part the training loop still waited for.
+    Leaving the loop early (break, exception, or close() on the iterator) stops the producer and drains the queue.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.fetch_time, self.wait_time = 0., 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def hidden_time(self):
+        return max(self.fetch_time - self.wait_time, 0.)
+
+    def to_device(self, batch):
+        if self.stream is None:
+            return to_device(batch, self.device), None
+        with torch.cuda.stream(self.stream):
+            batch = to_device(batch, self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    @staticmethod
+    def put(batches, stop, item):
+        """ Blocks until there is room in the queue or the consumer has stopped; False in the latter case. """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self, batches, stop):
+        try:
+            start_time = time.perf_counter()
+            for batch in self.loader:
+                batch = self.to_device(batch)
+                self.fetch_time += time.perf_counter() - start_time
+                if not self.put(batches, stop, batch):
+                    return
+                start_time = time.perf_counter()
+        except Exception as e:
+            self.put(batches, stop, e)
+        self.put(batches, stop, None)
+
+    def __iter__(self):
+        self.fetch_time, self.wait_time = 0., 0.
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start_time
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for key, val in batch.items():
+                        if val.is_cuda:
+                            # allocated on the side stream, used on the current one
+                            val.record_stream(current_stream)
+                yield batch
+        finally:
+            # the producer notices the event within a put timeout; the queued batches (and their device memory) are dropped
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
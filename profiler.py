@@ -0,0 +1,74 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class PhaseProfiler:
+    """
+    Wall-clock time per training phase (data wait, host-to-device copy, encoder, decoder, loss, backward, optimizer).
+    A step is split by lap(name) calls, each charging the time since the previous lap to `name`.
+    No device synchronization is done, so on GPU a phase shows launch time and the wait lands on the next
+    synchronizing phase; the Chrome trace window (trace_steps > 0) is meant for a closer look.
+    Only training steps are recorded: n_step (and trace_start) count training batches.
+    """
+    def __init__(self, trace_path=None, trace_start=10, trace_steps=20):
+        self.trace_path = trace_path
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps if trace_path else 0
+        self.trace_events = []
+        self.n_step = 0
+        self.reset()
+        self.step_start()
+
+    def reset(self):
+        self.phase_time = OrderedDict()
+        self.n_sample, self.n_token, self.n_pad, self.n_element = 0, 0, 0, 0
+        self.elapsed = 0.
+        self.steps = 0
+
+    def tracing(self):
+        return self.trace_start <= self.n_step < self.trace_start + self.trace_steps
+
+    def step_start(self):
+        self.last = time.perf_counter()
+        self.step_start_time = self.last
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.phase_time[name] = self.phase_time.get(name, 0.) + now - self.last
+        if self.tracing():
+            self.trace_events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                      'ts': self.last * 1e6, 'dur': (now - self.last) * 1e6, 'args': {'step': self.n_step}})
+        self.last = now
+
+    def step_end(self, n_sample, n_token, n_pad, n_element):
+        """ n_token: non-pad target tokens; n_pad / n_element: pad and total elements of post and response. """
+        now = time.perf_counter()
+        self.elapsed += now - self.step_start_time
+        self.n_sample += n_sample
+        self.n_token += n_token
+        self.n_pad += n_pad
+        self.n_element += n_element
+        self.steps += 1
+        self.n_step += 1
+        if self.trace_steps and self.n_step == self.trace_start + self.trace_steps:
+            self.dump_trace()
+        self.step_start()
+
+    def summary(self):
+        """ Averages since the last summary (then resets): ms per step for each phase and throughput. """
+        if self.steps == 0:
+            return {}
+        result = OrderedDict((f'Phase {name} (ms)', 1000. * t / self.steps) for name, t in self.phase_time.items())
+        result['Samples per sec'] = self.n_sample / self.elapsed
+        result['Tokens per sec'] = self.n_token / self.elapsed
+        result['Padding ratio'] = self.n_pad / max(self.n_element, 1)
+        self.reset()
+        return result
+
+    def dump_trace(self):
+        with open(self.trace_path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+        print(f'Chrome trace of steps {self.trace_start}-{self.n_step - 1} saved in {self.trace_path}')
+        self.trace_events = []
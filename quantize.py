@@ -0,0 +1,112 @@
+import argparse
+import random
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from dataset import get_dataloader
+from model import CCMModel, Baseline
+from criterion import criterion, perplexity, baseline_criterion, batch_loss
+
+
+class HalfEmbedding(nn.Module):
+    """ Frozen embedding table stored in fp16, looked up as fp32. """
+    def __init__(self, embedding):
+        super().__init__()
+        self.padding_idx = embedding.padding_idx
+        self.register_buffer('weight', embedding.weight.detach().half())
+
+    def forward(self, input):
+        return F.embedding(input, self.weight, self.padding_idx).float()
+
+
+def quantize_model(model, fp16_embedding=False):
+    """ In-place dynamic int8 quantization of every Linear/GRU (CPU inference only). """
+    model.eval()
+    if fp16_embedding:
+        for name in ['word_embedding', 'entity_embedding', 'rel_embedding']:
+            if hasattr(model, name):
+                setattr(model, name, HalfEmbedding(getattr(model, name)))
+    torch.quantization.quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def evaluate(model, loader, loss_fn):
+    """ Returns (average loss, average perplexity, generated tokens/sec) over the loader. """
+    model.eval()
+    total_loss, total_pp, n_sample, n_token, elapsed = 0., 0., 0, 0, 0.
+    with torch.no_grad():
+        for batch in loader:
+            batch_size = batch['response'].size()[0]
+            start_time = time.time()
+            output, pointer_prob, output_vocab = model(batch)
+            elapsed += time.time() - start_time
+            n_token += batch_size * output.size()[2]
+            loss, nll_loss = batch_loss(output, pointer_prob, batch, loss_fn, output_vocab)
+            total_loss += loss.item() * batch_size
+            total_pp += perplexity(nll_loss).item() * batch_size
+            n_sample += batch_size
+    return total_loss / n_sample, total_pp / n_sample, n_token / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parser')
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--model_path', type=str, default='best_model.pt')
+    parser.add_argument('--save_path', type=str, default=None)
+    parser.add_argument('--fp16_embedding', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--batch_access', type=int, default=16)
+    parser.add_argument('--teacher_forcing', type=float, default=1.0)
+    parser.add_argument('--d_embed', type=int, default=300)
+    parser.add_argument('--t_embed', type=int, default=100)
+    parser.add_argument('--hidden', type=int, default=128)
+    parser.add_argument('--n_glove_vocab', type=int, default=30000)
+    parser.add_argument('--n_entity_vocab', type=int, default=22590)
+    parser.add_argument('--gru_layer', type=int, default=2)
+    parser.add_argument('--gru_hidden', type=int, default=512)
+    parser.add_argument('--max_sentence_len', type=int, default=150)
+    parser.add_argument('--max_triple_len', type=int, default=50)
+    parser.add_argument('--max_response_len', type=int, default=150)
+    parser.add_argument('--data_piece_size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=41)
+    parser.add_argument('--num_workers', type=int, default=6)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--baseline', action='store_true')
+    args = parser.parse_args()
+    args.world_size = 1
+    args.local_rank = 0
+
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    val_loader = get_dataloader(args, data_path=args.data_dir, data_name='valid', batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    def build():
+        # models are rebuilt instead of deep-copied: CCMModel holds the dataset (and its Redis client)
+        model = CCMModel(args, val_loader.dataset) if not args.baseline else Baseline(args)
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+        return model
+
+    loss_fn = criterion if not args.baseline else baseline_criterion
+    fp32_model = build()
+    int8_model = quantize_model(build(), fp16_embedding=args.fp16_embedding)
+
+    results = {}
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        # the same sampler order (shuffle=False) is replayed for both models
+        loss, pp, tok_per_sec = evaluate(model, val_loader, loss_fn)
+        results[name] = (loss, pp, tok_per_sec)
+        print('{}: loss {:.4f} / perplexity {:.4f} / {:.1f} tokens/sec'.format(name, loss, pp, tok_per_sec))
+    print('====> perplexity delta: {:+.4f} / speedup: {:.2f}x'.format(
+        results['int8'][1] - results['fp32'][1],
+        results['int8'][2] / results['fp32'][2]))
+
+    if args.save_path:
+        # the dynamic quantized modules are not nn.Linear/nn.GRU anymore, so save the whole module
+        if hasattr(int8_model, 'dataset'):
+            int8_model.dataset = None
+        torch.save(int8_model, args.save_path)
+        print(f'Saved the quantized model in {args.save_path}')
@@ -1,6 +1,7 @@
 import time
 import torch
-from dataset import UNK_IDX, SOS_IDX, EOS_IDX, PAD_IDX
+from detokenizer import Detokenizer
+from profiler import PhaseProfiler
 
 
 class Recorder:
@@ -10,8 +11,12 @@ class Recorder:
         self.log_interval = args.log_interval
         self.writer = writer
         self.idx2word = idx2word
+        self.detokenizer = Detokenizer(idx2word)
         self.batch_access = args.batch_access
         self.batch_size = args.batch_size
+        self.profiler = None
+        if not getattr(args, 'no_profile', False):
+            self.profiler = PhaseProfiler(getattr(args, 'trace_path', None), getattr(args, 'trace_start', 10), getattr(args, 'trace_steps', 20))
         print(f'Record {self.timestamp}')
 
     def epoch_start(self, epoch_idx, is_train, loader):
@@ -23,16 +28,23 @@ class Recorder:
         self.epoch_pp = 0
         self.epoch_start_time = time.time()
         self.batch_start_time = time.time()
+        if self.profiler and is_train:
+            self.profiler.reset()
+            self.profiler.step_start()
 
     def batch_end(self, batch_idx, batch_size, loss, pp):
+        """
+        loss and pp are (detached) device tensors: they are summed on the device in float64, which gives the same
+        sums as adding their .item() values, and only read back (a device sync) at log intervals and epoch end.
+        """
         self.batch_end_time = time.time()
-        self.batch_loss = loss
-        self.batch_pp = pp
-        self.epoch_loss += self.batch_loss * batch_size
-        self.epoch_pp += self.batch_pp * batch_size
+        self.epoch_loss += loss.double() * batch_size
+        self.epoch_pp += pp.double() * batch_size
         self.batch_time = self.batch_end_time - self.batch_start_time
         self.batch_start_time = time.time()
         if self.mode == 'Train' and batch_idx % self.log_interval == 0:
+            self.batch_loss = loss.item()
+            self.batch_pp = pp.item()
             print('Train Batch: {} [{}/{}({:.0f}%)] Loss:{:.4f} / Time:{:.4f}'.format(
                 self.epoch_idx,
                 batch_idx * batch_size, self.dataset_size,
@@ -43,8 +55,35 @@ class Recorder:
             self.writer.add_scalar(f'{self.mode}-Batch loss', self.batch_loss, batch_record_idx)
             self.writer.add_scalar(f'{self.mode}-Batch perplexity', self.batch_pp, batch_record_idx)
             self.writer.add_scalar(f'{self.mode}-Batch time', self.batch_time, batch_record_idx)
+            if self.profiler:
+                for name, value in self.profiler.summary().items():
+                    self.writer.add_scalar(f'{self.mode}-{name}', value, batch_record_idx)
+
+    def log_prefetch(self, fetch_time, wait_time):
+        """ Loading/copy time of the epoch and how much of it was hidden behind compute by the prefetcher. """
+        hidden_time = max(fetch_time - wait_time, 0.)
+        print('====> {}: {} Prefetch: {:.4f} of {:.4f} loading time hidden'.format(self.mode, self.epoch_idx, hidden_time, fetch_time))
+        self.writer.add_scalar(f'{self.mode}-Epoch loading time', fetch_time, self.epoch_idx)
+        self.writer.add_scalar(f'{self.mode}-Epoch hidden loading time', hidden_time, self.epoch_idx)
+
+    def epoch_sums(self):
+        """ The (loss, perplexity) sums of the epoch so far, saved in mid-epoch checkpoints. """
+        return float(self.epoch_loss), float(self.epoch_pp)
+
+    def set_epoch_sums(self, loss, pp):
+        """ Resuming mid-epoch: starts from the sums of the batches trained before the checkpoint. """
+        self.epoch_loss = loss
+        self.epoch_pp = pp
+
+    def set_epoch_totals(self, loss, pp, dataset_size):
+        """ Replaces this rank's sums with the ones all-reduced over every rank (sharded validation). """
+        self.epoch_loss = loss
+        self.epoch_pp = pp
+        self.dataset_size = dataset_size
 
     def epoch_end(self):
+        self.epoch_loss = float(self.epoch_loss)
+        self.epoch_pp = float(self.epoch_pp)
         self.epoch_end_time = time.time()
         self.epoch_time = self.epoch_end_time - self.epoch_start_time
         print('====> {}: {} Average loss: {:.4f} / Time: {:.4f}'.format(
@@ -62,25 +101,16 @@ class Recorder:
             print()
             n = min(batch['response'].size()[0], 8)
             output = output[:n]
-            text_idx = list()
-            for batch_key in ['post', 'response']:
-                text_idx.append(batch[batch_key][:n].cpu())
-            text_idx.append(torch.max(output.cpu().detach(), 1)[1])
+            names = ['post', 'response', 'response_output']
+            sentences = [self.detokenizer(batch[batch_key][:n]) for batch_key in names[:2]]
+            sentences.append(self.detokenizer(torch.max(output.detach(), 1)[1]))
             text_all = list()
-            for n, lines in enumerate(zip(*text_idx)):
+            for n, lines in enumerate(zip(*sentences)):
                 texts = [f'{n + 1}']
                 print(n+1)
-                for name, line in zip(['post', 'response', 'response_output'], lines):
+                for name, sentence in zip(names, lines):
                     texts.append(name)
                     print(f'    {name}')
-                    line_text = []
-                    for idx in line:
-                        idx = idx.item()
-                        if idx == EOS_IDX:
-                            break
-                        if idx != SOS_IDX and idx != PAD_IDX:
-                            line_text.append(self.idx2word.get(idx, 'UNK'))
-                    sentence = ' '.join(line_text)
                     texts.append(sentence)
                     print(f'        {sentence}')
                 text_all.append(' - '.join(texts))
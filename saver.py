@@ -0,0 +1,93 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """ Recursively copies every tensor of a (state) dict/list to the CPU, detached from training. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(val) for val in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointSaver:
+    """
+    Writes checkpoints from a background thread so that training does not wait on the disk.
+    The training thread only takes a CPU snapshot (see snapshot); files are written to '<path>.tmp'
+    and renamed over <path>, so a preempted run never leaves a truncated checkpoint behind.
+    At most one write is pending: a new save waits for the previous one to finish.
+    """
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def snapshot(self, model, optimizer, epoch_idx, step, **extra):
+        """ Full training state on the CPU; step is the number of batches of epoch_idx already trained. """
+        state = {
+            'model': to_cpu(model.state_dict()),
+            'optimizer': to_cpu(optimizer.state_dict()),
+            'rng': rng_state(),
+            'epoch': epoch_idx,
+            'step': step,
+        }
+        state.update(extra)
+        return state
+
+    def save(self, *items):
+        """ Queues (obj, file name) pairs as one write; blocks only while the previous write is still running. """
+        if self.error is not None:
+            raise self.error
+        self.queue.put([(obj, os.path.join(self.checkpoint_dir, name)) for obj, name in items])
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while True:
+            items = self.queue.get()
+            try:
+                for obj, path in items:
+                    torch.save(obj, f'{path}.tmp')
+                    os.replace(f'{path}.tmp', path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+def load_checkpoint(path, model, optimizer=None):
+    """ Restores model (and optimizer/RNG) state in place; returns the checkpoint dict for epoch/step/extras. """
+    state = torch.load(path, map_location='cpu')
+    model.load_state_dict(state['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(state['optimizer'])
+        set_rng_state(state['rng'])
+    return state
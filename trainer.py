@@ -1,60 +1,120 @@
 import argparse
 import datetime
+import json
 import os
 import torch
 import random
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.optim as optim
 from tensorboardX import SummaryWriter
-from dataset import get_dataloader, PAD_IDX, NAF_IDX
-from model import CCMModel, Baseline
+from dataset import get_dataloader
+from prefetcher import Prefetcher
+from utils import init_distributed, to_device
+from model import CCMModel, Baseline, get_model_config
 from recorder import Recorder
-from criterion import criterion, perplexity, baseline_criterion
+from optimizer import get_optimizer
+from saver import CheckpointSaver, load_checkpoint
+from criterion import criterion, perplexity, baseline_criterion, fused_criterion, batch_loss
 import torch.distributed as dist
-from apex.parallel import DistributedDataParallel as DDP
-import ipdb
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 
-def epoch(epoch_idx, is_train=True):
+def epoch(epoch_idx, is_train=True, start_step=0, epoch_sums=None):
     model.train() if is_train else model.eval()
     loader = train_loader if is_train else val_loader
     if is_train and args.distributed:
         loader.sampler.set_epoch(epoch_idx)
+    # resuming mid-epoch: skip the batches already trained
+    loader.sampler.set_start(start_step * loader.batch_size)
     if recorder:
         recorder.epoch_start(epoch_idx, is_train, loader)
-    for batch_idx, batch in enumerate(loader):
+        if epoch_sums:
+            # the (loss, perplexity) sums of the batches trained before the checkpoint we resume from
+            recorder.set_epoch_sums(*epoch_sums)
+    # training steps only, so that --trace_start counts training batches
+    profiler = recorder.profiler if recorder and is_train else None
+    raw_model.profiler = profiler
+    # validation is sharded over ranks: local (loss, perplexity) sums are all-reduced at the end
+    val_sums = torch.zeros(2, dtype=torch.float64, device=device)
+    batches = Prefetcher(loader, device, args.prefetch) if args.prefetch else loader
+    output, batch = None, None  # a validation shard (or a resumed epoch) can have no batch
+    for batch_idx, batch in enumerate(batches, start=start_step):
         batch_size = batch['response'].size()[0]
-        batch = {key: val.to(device) for key, val in batch.items()}
+        if profiler:
+            profiler.lap('data')
+            # from the host-side lengths (pads are trailing), so no device sync
+            n_token = (batch['response_length'] - 1).sum().item()
+            n_element = batch['post'].numel() + batch['response'].numel()
+            n_pad = n_element - batch['post_length'].sum().item() - batch['response_length'].sum().item()
+        if not args.prefetch:
+            batch = to_device(batch, device)
+        if profiler:
+            profiler.lap('h2d')
         optimizer.zero_grad()
-        output, pointer_prob = model(batch)
-        pointer_prob_target = (batch['response_triple'] != NAF_IDX).all(-1).to(torch.float)
-        pointer_prob_target.data.masked_fill_(batch['response'] == 0, PAD_IDX)
-        loss, nll_loss = criterion(output, batch['response'][:, 1:], pointer_prob, pointer_prob_target[:, 1:])
-        pp = perplexity(nll_loss)
+        with torch.set_grad_enabled(is_train):
+            output, pointer_prob, output_vocab = model(batch)
+            if profiler:
+                profiler.lap('decoder')
+            loss_fn = fused_criterion if is_train and args.fused_loss else criterion
+            loss, nll_loss = batch_loss(output, pointer_prob, batch, loss_fn, output_vocab)
+            pp = perplexity(nll_loss)
+            if profiler:
+                profiler.lap('loss')
         if is_train:
             loss.backward()
+            if profiler:
+                profiler.lap('backward')
             optimizer.step()
+            if profiler:
+                profiler.lap('optimizer')
+        else:
+            val_sums += torch.stack([loss.detach().double(), pp.detach().double()]) * batch_size
         if recorder:
-            recorder.batch_end(batch_idx, batch_size, loss.item(), pp.item())
+            recorder.batch_end(batch_idx, batch_size, loss.detach(), pp.detach())
+        if profiler:
+            profiler.step_end(batch_size, n_token, n_pad, n_element)
+        # not after the last batch: the end-of-epoch checkpoint (after validation) follows
+        if is_train and saver and args.checkpoint_interval and (batch_idx + 1) % args.checkpoint_interval == 0 \
+                and batch_idx + 1 < len(loader):
+            state = saver.snapshot(raw_model, optimizer, epoch_idx, batch_idx + 1, min_loss=min_loss, epoch_sums=recorder.epoch_sums())
+            saver.save((state, 'checkpoint_last.pt'))
+    loader.sampler.set_start(0)
+    if args.prefetch and recorder:
+        recorder.log_prefetch(batches.fetch_time, batches.wait_time)
+    if not is_train and args.distributed:
+        val_sums = torch.cat([val_sums, torch.tensor([len(loader.sampler) * args.batch_access], dtype=torch.float64, device=device)])
+        dist.all_reduce(val_sums)
+        if recorder:
+            recorder.set_epoch_totals(*val_sums.tolist())
     if recorder:
-        recorder.log_text(output, batch)
+        if batch is not None:
+            recorder.log_text(output, batch)
         recorder.epoch_end()
         return recorder.epoch_loss
 
 
-def train():
-    min_loss = float('inf')
-    for epoch_idx in range(1, args.epochs + 1):
-        epoch(epoch_idx, is_train=True)
-        if args.local_rank == 0:
-            loss = epoch(epoch_idx, is_train=False)
-            if loss < min_loss:
-                min_loss = loss
-                torch.save(model.state_dict(), 'best_model.pt')
+def train(start_epoch=1, start_step=0, epoch_sums=None):
+    global min_loss
+    for epoch_idx in range(start_epoch, args.epochs + 1):
+        if start_step < len(train_loader):
+            epoch(epoch_idx, is_train=True, start_step=start_step, epoch_sums=epoch_sums)
+        else:
+            # checkpointed after the last batch of the epoch: only its validation is left
+            print(f'Epoch {epoch_idx} already trained, resuming at its validation')
+        start_step, epoch_sums = 0, None
+        loss = epoch(epoch_idx, is_train=False)
+        if saver:
+            is_best = loss < min_loss
+            min_loss = min(loss, min_loss)
+            state = saver.snapshot(raw_model, optimizer, epoch_idx + 1, 0, min_loss=min_loss)
+            if is_best:
+                saver.save((state, 'checkpoint_last.pt'), (state, 'checkpoint_best.pt'), (state['model'], 'best_model.pt'))
                 print(f'Saved the best model with loss {min_loss}')
-
+            else:
+                saver.save((state, 'checkpoint_last.pt'))
+    if saver:
+        saver.wait()
 
 
 if __name__ == '__main__':
@@ -82,38 +142,40 @@ if __name__ == '__main__':
     parser.add_argument('--data_piece_size', type=int, default=10000)
     parser.add_argument('--seed', type=int, default=41)
     parser.add_argument('--num_workers', type=int, default=6)
-    parser.add_argument('--local_rank', type=int, default=0)
+    # torch.distributed.launch passes --local-rank on torch >= 2.0 and --local_rank before
+    parser.add_argument('--local-rank', '--local_rank', dest='local_rank', type=int, default=int(os.environ.get('LOCAL_RANK', 0)))
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads per process (default: cores / local processes)')
     parser.add_argument('--no_cuda', action='store_true')
     parser.add_argument('--baseline', action='store_true')
+    parser.add_argument('--sampled_softmax', type=int, default=0, help='train the generic vocab head with this many sampled negatives (0: exact)')
+    parser.add_argument('--fused_loss', action='store_true', help='train with the log-space pointer-generator NLL (CCM only)')
+    parser.add_argument('--checkpoint_segment', type=int, default=0, help='checkpoint the teacher-forced CCM decoder every k steps (0: off; needs --teacher_forcing 1, not --baseline)')
+    parser.add_argument('--sparse_embedding', action='store_true', help='sparse embedding gradients updated by SparseAdam')
+    parser.add_argument('--no_profile', action='store_true', help='do not record per-phase timings')
+    parser.add_argument('--trace_path', type=str, default=None, help='write a Chrome trace of --trace_steps steps here')
+    parser.add_argument('--trace_start', type=int, default=10)
+    parser.add_argument('--trace_steps', type=int, default=20, help='steps in the trace (with --trace_path)')
+    parser.add_argument('--checkpoint_dir', type=str, default='.')
+    parser.add_argument('--checkpoint_interval', type=int, default=0, help='also save checkpoint_last.pt every n training batches')
+    parser.add_argument('--resume', type=str, default=None, help='checkpoint to resume from (e.g. checkpoint_last.pt)')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches loaded and copied ahead in a background thread (0: off)')
+    parser.add_argument('--unique_triple', action='store_true', help='embed each unique triple of a batch once (CCM only)')
     args = parser.parse_args()
+    if args.trace_path and (args.trace_steps <= 0 or args.no_profile):
+        parser.error('--trace_path needs --trace_steps > 0 and the profiler (no --no_profile)')
 
     if args.seed is not None:
         random.seed(args.seed)
         torch.manual_seed(args.seed)
         cudnn.deterministic = True
 
-    if torch.cuda.is_available():
-        device = torch.device('cuda')
-    else:
-        device = torch.device('cpu')
-
-    args.distributed = False
-    args.world_size = 1
-    if 'WORLD_SIZE' in os.environ:
-        args.world_size = int(os.environ['WORLD_SIZE'])
-        args.distributed = args.world_size > 1
-
-    if args.distributed:
-        # FOR DISTRIBUTED:  Set the device according to local_rank.
-        torch.cuda.set_device(args.local_rank)
-
-        # FOR DISTRIBUTED:  Initialize the backend.  torch.distributed.launch will provide
-        # environment variables, and requires that you use init_method=`env://`.
-        dist.init_process_group(backend='nccl',
-                                init_method='env://')
+    device = init_distributed(args)
+    if args.sparse_embedding and args.distributed and device.type == 'cuda':
+        # DDP all-reduces sparse gradients on gloo only: nccl rejects them at the first backward
+        parser.error('--sparse_embedding is not supported by distributed training on GPUs (nccl), use --no_cuda (gloo)')
 
     # Data loading code
-    train_loader = get_dataloader(args, data_path=args.data_dir, data_name='train', batch_size=args.batch_size, num_workers=args.num_workers, distributed=args.distributed)
+    train_loader = get_dataloader(args, data_path=args.data_dir, data_name='train', batch_size=args.batch_size, num_workers=args.num_workers)
     val_loader = get_dataloader(args, data_path=args.data_dir, data_name='valid', batch_size=args.batch_size, num_workers=args.num_workers)
     # create model
     if not args.baseline:
@@ -121,13 +183,28 @@ if __name__ == '__main__':
     else:
         model = Baseline(args).to(device)
         criterion = baseline_criterion
-    optimizer = optim.Adam(model.parameters(), args.lr)
+        args.fused_loss = False
+    if args.rank == 0:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+        with open(os.path.join(args.checkpoint_dir, 'best_model.json'), 'w') as f:
+            json.dump(get_model_config(args, train_loader.dataset), f)
+    optimizer = get_optimizer(model, args.lr, args.sparse_embedding)
+    raw_model = model
+    min_loss = float('inf')
+    start_epoch, start_step, epoch_sums = 1, 0, None
+    if args.resume:
+        state = load_checkpoint(args.resume, model, optimizer)
+        start_epoch, start_step, min_loss = state['epoch'], state['step'], state['min_loss']
+        epoch_sums = state.get('epoch_sums')
+        print(f'Resumed from {args.resume} at epoch {start_epoch}, step {start_step}')
     if args.distributed:
-        model = DDP(model)
+        # native DDP: gloo on CPU, nccl on GPU; sparse embedding gradients on gloo only (see above)
+        model = DDP(model, device_ids=[device.index] if device.type == 'cuda' else None)
 
-    recorder = None
-    if args.local_rank == 0:
+    recorder, saver = None, None
+    if args.rank == 0:
+        saver = CheckpointSaver(args.checkpoint_dir)
         writer = SummaryWriter(f'{args.log_dir}/{args.project}_{"b" if args.baseline else "c"}_{args.timestamp}')
         recorder = Recorder(args, writer, train_loader.dataset.idx2word)
 
-    train()
+    train(start_epoch, start_step, epoch_sums)
@@ -1,5 +1,7 @@
+import os
 import numpy as np
-import zarr
+import torch
+import torch.distributed as dist
 
 def line_count(filename):
     def _make_gen(reader):
@@ -12,6 +14,11 @@ def line_count(filename):
     f_gen = _make_gen(f.raw.read)
     return sum( buf.count(b'\n') for buf in f_gen )
 
+def to_device(batch, device, non_blocking=False):
+    """ Copies a batch to device; lengths (and sample ids) stay on the host, where pack_padded_sequence reads them without a sync. """
+    return {key: val if key.endswith('_length') or key == 'index' else val.to(device, non_blocking=non_blocking)
+            for key, val in batch.items()}
+
 def pad_1d(lst, length, pad_idx=0):
     """ Pad over axis 0. """
     return np.pad(lst, (0, length-len(lst)), 'constant', constant_values=pad_idx)
@@ -25,7 +32,36 @@ def pad_2d(lst_of_lst, length, pad_idx=0):
     return res
 
 def append_storage(storage, append_len):
+    import zarr
     storage.append(zarr.zeros((append_len, *storage.shape[1:])))
 
 def resize_storage(storage, len):
-    storage.resize(len, *storage.shape[1:])
\ No newline at end of file
+    storage.resize(len, *storage.shape[1:])
+
+
+def init_distributed(args):
+    """
+    Sets args.distributed/world_size/rank from the launcher's environment (torch.distributed.launch or torchrun),
+    pins intra-op threads per process and initializes the process group: nccl on GPU, gloo on CPU.
+    Returns the device of this process.
+    """
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.distributed = args.world_size > 1
+    args.rank = int(os.environ.get('RANK', args.local_rank))
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    device = torch.device('cuda', args.local_rank) if use_cuda else torch.device('cpu')
+
+    num_threads = getattr(args, 'num_threads', None)
+    if not num_threads and args.distributed and not use_cuda:
+        # local processes share the cores instead of each spawning cpu_count() threads
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))
+        num_threads = max(1, os.cpu_count() // local_world_size)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if args.distributed:
+        if use_cuda:
+            torch.cuda.set_device(device)
+        dist.init_process_group(backend='nccl' if use_cuda else 'gloo', init_method='env://')
+        args.rank = dist.get_rank()
+    return device